@@ -1,19 +1,40 @@
-# pylint: disable=C0103,R0912,R0915,C0301,R0914,R0902
+# pylint: disable=C0103,R0912,R0915,C0301,R0914,R0902,C0413
 # pylint: disable=no-member
 """SZ Parking Service module"""
+import os
+import re
 import socket
+import sys
 import time
+# process start for the startup report (module imports included)
+T_START = time.perf_counter()
+import codecs
 import sqlite3
+import io
+import gzip
+import zlib
+import csv
+import json
 import logging
 from logging.handlers import RotatingFileHandler
+import argparse
 import configparser
 from datetime import datetime, timedelta
 import threading
-import requests
+import queue
+import weakref
+from types import MappingProxyType
+from collections import Counter, OrderedDict, deque, namedtuple
+from bisect import bisect_left
+from itertools import groupby, islice
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
 import serial
-from flask import Flask, request, redirect
+from urllib.parse import urlencode
+from pathlib import Path
+from contextlib import contextmanager
+from html import escape
+from flask import Flask, Response, request, redirect, stream_with_context
 from flask_httpauth import HTTPBasicAuth
-from pymodbus.client.sync import ModbusTcpClient as ModbusClient
 
 # result constants
 R_OK = 0
@@ -23,12 +44,1413 @@ R_FAIL_FN = 4
 R_FAIL_TYPE = 8
 R_FAIL_MULTI = 16
 
+# longest frame kept in the serial buffer before it is dropped
+SCAN_MAX_FRAME = 1024
+# rows per base page and rows rendered per streamed chunk
+BASE_PAGE_SIZE = 500
+BASE_CHUNK_SIZE = 50
+# page reload interval of clients that got no live slot (sec)
+LIVE_POLL = 10
+# log page: default number of lines, read block size (bytes), live tail poll interval (sec)
+LOG_LINES = 200
+LOG_BLOCK_SIZE = 65536
+LOG_TAIL_INTERVAL = 0.5
+LOG_LINE_TIME = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d')
+LOG_LIVE_JS = """<script>
+var live = document.getElementById('live');
+var tail = new EventSource('/log/tail');
+tail.onmessage = function(e) {
+    live.insertAdjacentText('afterend', e.data + '\\n');
+};
+// no free live slot: reload the page instead
+tail.onerror = function() {
+    if (tail.readyState == EventSource.CLOSED) setTimeout(function() { location.reload(); }, LIVE_POLL);
+};
+</script>""".replace('LIVE_POLL', str(LIVE_POLL * 1000))
+STATUS_LIVE_JS = """<script>
+function set(id, html) {
+    var e = document.getElementById(id);
+    if (e) e.innerHTML = html;
+}
+var events = new EventSource('/events');
+events.addEventListener('pc', function(e) {
+    var d = JSON.parse(e.data);
+    set('pc_value', d.value);
+    set('pc_remaining', d.remaining);
+});
+events.addEventListener('scan', function(e) {
+    var d = JSON.parse(e.data);
+    set('lane_' + d.lane, d.lane_status);
+    set('last_scan', d.time + ' lane ' + d.lane + ': ' + d.result);
+    set('scan_latency', d.latency.toFixed(1) + ' ms');
+});
+events.addEventListener('health', function(e) {
+    var d = JSON.parse(e.data);
+    for (var id in d) set(id, d[id]);
+});
+// no free live slot: reload the page instead
+events.onerror = function() {
+    if (events.readyState == EventSource.CLOSED) setTimeout(function() { location.reload(); }, LIVE_POLL);
+};
+</script>""".replace('LIVE_POLL', str(LIVE_POLL * 1000))
+# report columns: fail reasons counted by result bit
+REPORT_REASONS = (('multiple_use', R_FAIL_MULTI), ('time_exceed', R_FAIL_TIME), ('online_failed', R_FAIL_ONLINE),
+                  ('invalid_type', R_FAIL_TYPE), ('invalid_fn', R_FAIL_FN))
+# pending events per live status client, a client falling behind is disconnected
+LIVE_QUEUE = 100
+# live status keep-alive interval, also detects closed clients (sec)
+LIVE_KEEPALIVE = 15
+# attempts of background online recheck before giving up
+ONLINE_RETRIES = 5
+# modbus reconnect backoff limits (sec)
+MB_BACKOFF_MIN = 0.5
+MB_BACKOFF_MAX = 30
+# modbus session health check (one register read) interval when idle (sec)
+MB_HEALTH_INTERVAL = 5
+# max wait for a queued modbus command (sec)
+MB_CALL_TIMEOUT = 10
+# delay before retrying a failed coil off write (sec)
+PULSE_RETRY = 1
+
+# statements executed by the writer thread
+SQL_INSERT = 'INSERT INTO checks(date, result, ch_date, ch_sum, ch_fn, ch_fd, ch_fp, ch_t, raw) VALUES (?,?,?,?,?,?,?,?,?)'
+SQL_ONLINE_OK = 'UPDATE checks SET result = result & ~{} WHERE date = ? AND ch_fd = ? AND ch_fp = ?'.format(R_FAIL_ONLINE)
+SQL_ONLINE_FAIL = 'UPDATE checks SET result = result | {} WHERE date = ? AND ch_fd = ? AND ch_fp = ?'.format(R_FAIL_ONLINE)
+SQL_PC = 'INSERT OR REPLACE INTO pc(rowid, value) VALUES (1, ?)'
+# compact typed check history: epoch seconds, sum in kopecks, raw payload only if it
+# can not be rebuilt from the other columns; ids are never reused, so archived
+# checks keep unique ids and export pagination by id stays ordered
+SQL_CHECKS_TABLE = """CREATE TABLE IF NOT EXISTS {}checks(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date INT,
+    result INT,
+    ch_date INT,
+    ch_sum INT,
+    ch_fn INT,
+    ch_fd INT,
+    ch_fp INT,
+    ch_t INT,
+    raw TEXT)"""
+
+# max statements written in one transaction
+DB_BATCH_SIZE = 1000
+# largest value of sqlite INTEGER (64-bit signed)
+DB_INT_MAX = 2 ** 63 - 1
+# archive job check interval (sec)
+DB_RETENTION_INTERVAL = 3600
+# checks table columns in export files (also SQL_INSERT parameter order)
+EXPORT_FIELDS = ('date', 'result', 'ch_date', 'ch_sum', 'ch_fn', 'ch_fd', 'ch_fp', 'ch_t', 'raw')
+# rows read per query, also rows per block of the columns format
+EXPORT_CHUNK = 5000
+# columns stored as differences from the previous value in column blocks
+EXPORT_DELTA = ('date', 'ch_date', 'ch_fd')
+# rows per bulk import transaction
+IMPORT_BATCH = 50000
+# latency histogram bucket bounds (sec)
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# metric types and help texts in /metrics output order
+METRIC_HELP = OrderedDict([
+    ('szpark_frame_read_seconds', ('histogram', 'Serial frame read time from the first byte')),
+    ('szpark_parse_seconds', ('histogram', 'Check decode and validation time')),
+    ('szpark_dup_check_seconds', ('histogram', 'Multiple use check time')),
+    ('szpark_online_check_seconds', ('histogram', 'Online check time')),
+    ('szpark_decision_seconds', ('histogram', 'Scan to barrier decision time')),
+    ('szpark_scans_total', ('counter', 'Scanned checks by lane and result')),
+    ('szpark_db_write_seconds', ('histogram', 'Base write transaction time')),
+    ('szpark_db_rows_total', ('counter', 'Statements written to base')),
+    ('szpark_db_errors_total', ('counter', 'Failed base write transactions')),
+    ('szpark_base_query_seconds', ('histogram', 'Base page query time')),
+    ('szpark_modbus_command_seconds', ('histogram', 'Modbus command time by operation')),
+    ('szpark_modbus_errors_total', ('counter', 'Failed modbus commands by operation')),
+    ('szpark_modbus_connect_failures_total', ('counter', 'Failed modbus connects')),
+    ('szpark_pc_poll_seconds', ('histogram', 'Parking counter poll time')),
+    ('szpark_parking_counter', ('gauge', 'Parking counter value')),
+    ('szpark_queue_size', ('gauge', 'Items waiting in pipeline queue')),
+    ('szpark_queue_dropped_total', ('counter', 'Items dropped on pipeline queue overflow')),
+    ('szpark_startup_seconds', ('gauge', 'Time from process start to the end of startup phase')),
+    ('szpark_thread_alive', ('gauge', 'Thread liveness (1 alive, 0 dead)')),
+    ('szpark_thread_heartbeat_age_seconds', ('gauge', 'Time since the last heartbeat of supervised thread')),
+    ('szpark_thread_restarts_total', ('counter', 'Supervised thread restarts')),
+])
+# supervisor check interval (sec)
+SUP_CHECK_INTERVAL = 0.5
+# idle workers wake up at least this often to send a heartbeat (sec)
+SUP_BEAT_INTERVAL = 1
+# first delay of repeated restarts, doubled up to watch_interval (sec)
+SUP_BACKOFF_MIN = 1
+# worker running this long before failing is restarted without delay (sec)
+SUP_STABLE_TIME = 60
+# stacks shown on the profile page
+PROFILE_TOP = 200
+# config file check interval when automatic reload is disabled (sec)
+CFG_IDLE_INTERVAL = 5
+# config keys used only when threads and connections are created
+CFG_RESTART_KEYS = ('scan_queue', 'scan_workers', 'write_queue',
+                    'db_commit_interval', 'mbcip', 'mbcport', 'online_pool', 'online_cache_size',
+                    'online_cache_ttl', 'pc_enable', 'www_addr', 'www_port', 'www_server',
+                    'www_threads', 'live_clients', 'watchdog')
+# lane config keys used only when the serial port is opened
+LANE_RESTART_KEYS = ('com', 'speed', 'scan_gap')
+# ini section prefix for lanes
+LANE_SECTION = 'lane.'
+
 # flask app for web inerface
 app = Flask(__name__)
 auth = HTTPBasicAuth()
 users = {
 }
+# guards parking counter value against concurrent reset
 pc_lock = threading.RLock()
+# serializes config reloads (readers never lock)
+cfg_lock = threading.Lock()
+
+class StageQueue(queue.Queue):
+    """Bounded pipeline queue counting items dropped on overflow"""
+    def __init__(self, name, maxsize):
+        queue.Queue.__init__(self, maxsize)
+        self.name = name
+        self.drops = 0
+
+    def offer(self, item):
+        """Put item without blocking, drop it if the queue is full"""
+        try:
+            self.put_nowait(item)
+            return True
+        except queue.Full:
+            self.drops = self.drops + 1
+            logging.warning('%s queue full, dropping: %s', self.name, item)
+            return False
+
+    def status(self):
+        """Queue depth and drop counter as text"""
+        return '{}/{} (dropped: {})'.format(self.qsize(), self.maxsize, self.drops)
+
+class RateCounter(object):
+    """Events per second over a sliding window"""
+    def __init__(self, window=60):
+        self.window = window
+        self.events = deque()
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def tick(self):
+        """Count one event"""
+        with self.lock:
+            self.events.append(time.monotonic())
+            self.total = self.total + 1
+
+    def rate(self):
+        """Events per second within the window"""
+        since = time.monotonic() - self.window
+        with self.lock:
+            while self.events and self.events[0] < since:
+                self.events.popleft()
+            return len(self.events) / float(self.window)
+
+def metric_labels(labels):
+    """Format label pairs for Prometheus text format"""
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in labels) + '}'
+
+class Metrics(object):
+    """Counters and latency histograms exported in Prometheus text format
+
+    Series are created on first use and keyed by name and label pairs.
+    """
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """Add value to counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add value (sec) to histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.series.get(key)
+            if hist is None:
+                # bucket counts, +Inf count, sum
+                hist = self.series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            hist[bisect_left(self.buckets, value)] += 1
+            hist[-1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe run time of the with block"""
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t_start, **labels)
+
+    def text(self, samples=()):
+        """All series as text, samples are extra (name, labels, value) taken at scrape time"""
+        with self.lock:
+            series = [(name, labels, list(value) if isinstance(value, list) else value)
+                      for (name, labels), value in self.series.items()]
+        series.extend((name, tuple(sorted((k, str(v)) for k, v in labels.items())), value)
+                      for name, labels, value in samples)
+        series.sort(key=lambda item: (item[0], item[1]))
+        lines = []
+        for name, (kind, help_text) in METRIC_HELP.items():
+            items = [item for item in series if item[0] == name]
+            if not items:
+                continue
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for _, labels, value in items:
+                if kind != 'histogram':
+                    lines.append('{}{} {}'.format(name, metric_labels(labels), value))
+                    continue
+                count = 0
+                for bound, n in zip(self.buckets + ('+Inf',), value):
+                    count = count + n
+                    lines.append('{}_bucket{} {}'.format(name, metric_labels(labels + (('le', bound),)), count))
+                lines.append('{}_sum{} {}'.format(name, metric_labels(labels), value[-1]))
+                lines.append('{}_count{} {}'.format(name, metric_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+# process wide metrics
+metrics = Metrics()
+
+class Worker(object):
+    """Supervised thread function with heartbeat and restart state
+
+    stall returns the max heartbeat age (sec), None checks liveness only.
+    """
+    def __init__(self, name, target, args=(), stall=None, cleanup=None):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.stall = stall
+        self.cleanup = cleanup
+        self.thread = None
+        self.beat_time = 0
+        self.started = 0
+        self.restarts = 0
+        self.backoff = 0
+        self.restart_at = None
+
+    def alive(self):
+        """Thread is running and not waiting for restart"""
+        return self.restart_at is None and self.thread is not None and self.thread.is_alive()
+
+    def problem(self, now):
+        """Reason to restart the worker or None if it is healthy"""
+        if not self.thread.is_alive():
+            return 'thread exited'
+        if self.stall is not None and now - self.beat_time > self.stall():
+            return 'no heartbeat for {:.1f} s'.format(now - self.beat_time)
+        return None
+
+class Supervisor(object):
+    """Starts worker threads and restarts dead or stalled ones with backoff
+
+    Workers call heartbeat() from their loops. A replaced thread exits
+    quietly (SystemExit) on its next heartbeat, so a worker never runs twice.
+    """
+    def __init__(self):
+        self.workers = OrderedDict()
+        self.threads = {}
+        self.retired = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.reason = ''
+        self.reason_time = 0
+
+    def add(self, name, target, args=(), stall=None, cleanup=None):
+        """Register worker and start its thread"""
+        worker = Worker(name, target, args, stall, cleanup)
+        with self.lock:
+            self.workers[name] = worker
+        self.start(worker)
+        return worker
+
+    def start(self, worker):
+        """Start new thread for worker"""
+        thread = threading.Thread(target=worker.target, args=worker.args, name=worker.name)
+        with self.lock:
+            self.threads.pop(worker.thread, None)
+            self.threads[thread] = worker
+            worker.thread = thread
+            worker.beat_time = worker.started = time.monotonic()
+            worker.restart_at = None
+        thread.start()
+
+    def heartbeat(self):
+        """Mark the calling worker as making progress (no-op in other threads)"""
+        thread = threading.current_thread()
+        worker = self.threads.get(thread)
+        if worker is not None:
+            worker.beat_time = time.monotonic()
+        elif thread in self.retired:
+            raise SystemExit()
+
+    def alive(self, name):
+        """Worker is running"""
+        worker = self.workers.get(name)
+        return worker is not None and worker.alive()
+
+    def check(self, backoff_max):
+        """Restart dead and stalled workers, repeated failures wait up to backoff_max seconds"""
+        now = time.monotonic()
+        for worker in list(self.workers.values()):
+            if worker.restart_at is None:
+                reason = worker.problem(now)
+                if reason is None:
+                    continue
+                if now - worker.started < SUP_STABLE_TIME:
+                    worker.backoff = min(max(worker.backoff * 2, SUP_BACKOFF_MIN), backoff_max)
+                else:
+                    worker.backoff = 0
+                logging.warning('Thread %s: %s, restarting in %.0f s', worker.name, reason, worker.backoff)
+                self.reason = '{}: {}'.format(worker.name, reason)
+                self.reason_time = time.time()
+                with self.lock:
+                    self.threads.pop(worker.thread, None)
+                    self.retired.add(worker.thread)
+                    worker.restart_at = now + worker.backoff
+                if worker.cleanup is not None:
+                    try:
+                        worker.cleanup()
+                    except Exception as e: # pylint: disable=broad-except
+                        logging.warning('Thread %s cleanup failed: %s', worker.name, e)
+            if worker.restart_at <= now:
+                worker.restarts = worker.restarts + 1
+                self.start(worker)
+
+    def status(self):
+        """Worker and restart counters as html"""
+        workers = list(self.workers.values())
+        text = '{} threads, {} restarts'.format(len(workers), sum(w.restarts for w in workers))
+        waiting = [w.name for w in workers if w.restart_at is not None]
+        if waiting:
+            text = text + ', <font color="#AA0000">restarting: {}</font>'.format(escape(', '.join(waiting)))
+        return text
+
+    def last_restart(self):
+        """Time and reason of the last restart as html"""
+        if not self.reason:
+            return 'none'
+        return '{} {}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.reason_time)), escape(self.reason))
+
+# supervised worker threads
+supervisor = Supervisor()
+
+class Sampler(object):
+    """Sampling profiler counting thread stacks taken every interval seconds"""
+    def __init__(self):
+        self.stacks = Counter()
+        self.samples = 0
+        self.interval = 0.01
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock()
+
+    def start(self, interval):
+        """Start sampling if not running"""
+        self.interval = interval
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info('Profiler started (interval %.3f s)', interval)
+
+    def stop(self):
+        """Stop sampling, collected stacks are kept"""
+        if self.running:
+            self.running = False
+            logging.info('Profiler stopped after %d samples', self.samples)
+
+    def reset(self):
+        """Forget collected stacks"""
+        with self.lock:
+            self.stacks.clear()
+            self.samples = 0
+
+    def run(self):
+        """Sampler thread: record stacks of all other threads"""
+        own = threading.get_ident()
+        while self.running:
+            names = dict((th.ident, th.name) for th in threading.enumerate())
+            frames = sys._current_frames() # pylint: disable=protected-access
+            with self.lock:
+                self.samples = self.samples + 1
+                for ident, frame in frames.items():
+                    if ident == own:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append('{} ({}:{})'.format(frame.f_code.co_name,
+                                                         os.path.basename(frame.f_code.co_filename), frame.f_lineno))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    self.stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def text(self, limit=PROFILE_TOP):
+        """Most frequent stacks in collapsed format (flamegraph.pl input)"""
+        with self.lock:
+            top = self.stacks.most_common(limit)
+            samples = self.samples
+        state = 'running' if self.running else 'stopped'
+        lines = ['# profiler {}, {} samples every {:.3f} s'.format(state, samples, self.interval)]
+        lines.extend('{} {}'.format(stack, n) for stack, n in top)
+        return '\n'.join(lines) + '\n'
+
+# lane settings, one per [lane.<name>] section
+LaneCfg = namedtuple('LaneCfg', 'name com speed mbccoil mbctime scan_gap scan_terminator')
+
+class Lane(object):
+    """Scanner lane: serial port, reader thread and decision counters
+
+    The lane config is replaced on reload, the rest lives as long as the process.
+    """
+    def __init__(self, cfg):
+        self.name = cfg.name
+        self.cfg = cfg
+        self.serial = None
+        self.scans = RateCounter()
+        self.accepted = 0
+        self.rejected = 0
+        self.latency = 0
+        self.lock = threading.Lock()
+
+    def count(self, result, latency):
+        """Count one decision and its latency (ms)"""
+        self.scans.tick()
+        with self.lock:
+            if result == R_OK:
+                self.accepted += 1
+            else:
+                self.rejected += 1
+            self.latency = latency
+
+    def close(self):
+        """Close serial port (also wakes up a reader stuck in read)"""
+        port, self.serial = self.serial, None
+        if port is not None:
+            port.close()
+
+    def status(self):
+        """Lane counters as text"""
+        if supervisor.alive('scan:' + self.name):
+            state = '<font color="#00AA00">alive</font>'
+        else:
+            state = '<font color="#AA0000">dead</font>'
+        if self.serial is None or not self.serial.isOpen():
+            state += ', <font color="#AA0000">port closed</font>'
+        return '{}, scans: {} ({:.2f}/s), ok: {}, rejected: {}, last latency: {:.1f} ms'.format(
+            state, self.scans.total, self.scans.rate(), self.accepted, self.rejected, self.latency)
+
+class Broadcaster(object):
+    """Fans out server-sent events to all live status clients
+
+    The last message of each event type is replayed to new clients so
+    they start with the current state.
+    """
+    def __init__(self):
+        self.clients = set()
+        self.last = OrderedDict()
+        self.lock = threading.Lock()
+
+    def publish(self, event, data):
+        """Send event with JSON data to every client without waiting"""
+        message = 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
+        with self.lock:
+            self.last[event] = message
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.put_nowait(message)
+            except queue.Full:
+                with self.lock:
+                    self.clients.discard(client)
+
+    def stream(self):
+        """Yield events for one client until it disconnects or falls behind"""
+        client = queue.Queue(LIVE_QUEUE)
+        with self.lock:
+            for message in self.last.values():
+                client.put_nowait(message)
+            self.clients.add(client)
+        try:
+            while True:
+                try:
+                    yield client.get(timeout=LIVE_KEEPALIVE)
+                except queue.Empty:
+                    with self.lock:
+                        if client not in self.clients:
+                            return
+                    yield ':\n\n'
+        finally:
+            with self.lock:
+                self.clients.discard(client)
+
+class DupIndex(object):
+    """In-memory index of checks scanned within the valid check interval
+
+    Checks are identified by (fn, fd, fp), scan dates are epoch seconds.
+    """
+    def __init__(self, interval):
+        self.interval = interval.total_seconds()
+        self.seen = {}
+        self.order = deque()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.load_time = 0
+
+    def load(self, cursor):
+        """Fill index from base with checks scanned within the interval"""
+        t_start = time.perf_counter()
+        since = time.time() - self.interval
+        try:
+            with self.lock:
+                self.seen.clear()
+                self.order.clear()
+                for ch_fn, ch_fd, ch_fp, date in cursor.execute(
+                        'SELECT ch_fn, ch_fd, ch_fp, date FROM checks WHERE date >= ? ORDER BY date', (since,)):
+                    key = (ch_fn, ch_fd, ch_fp)
+                    if key not in self.seen:
+                        self.seen[key] = date
+                        self.order.append((date, key))
+        finally:
+            self.ready.set()
+        self.load_time = time.perf_counter() - t_start
+        logging.info('Loaded %d checks to index in %.3f s', len(self.seen), self.load_time)
+
+    def check_add(self, key, date):
+        """Return True if check was already scanned, otherwise remember it
+
+        Waits for the index load started with the service.
+        """
+        self.ready.wait()
+        since = time.time() - self.interval
+        with self.lock:
+            # evict checks scanned before the interval
+            while self.order and self.order[0][0] < since:
+                old_date, old_key = self.order.popleft()
+                if self.seen.get(old_key) == old_date:
+                    del self.seen[old_key]
+            if key in self.seen:
+                return True
+            self.seen[key] = date
+            self.order.append((date, key))
+            return False
+
+    def memory(self):
+        """Approximate memory used by index (bytes)"""
+        with self.lock:
+            size = sys.getsizeof(self.seen) + sys.getsizeof(self.order)
+            for date, key in self.order:
+                size = size + sys.getsizeof(date) + sys.getsizeof(key) + sum(sys.getsizeof(v) for v in key) + 64
+        return size
+
+    def status(self):
+        """Index size, memory and load time as text"""
+        if not self.ready.is_set():
+            return 'loading'
+        return '{} checks, {:.1f} KiB (loaded in {:.3f} s)'.format(
+            len(self.seen), self.memory() / 1024, self.load_time)
+
+# decoded check, first nine fields are the checks table row
+Check = namedtuple('Check', 'date result ch_date ch_sum ch_fn ch_fd ch_fp ch_t raw s fp label')
+# fields every check QR code must have
+QR_FIELDS = ('t', 's', 'fn', 'i', 'fp', 'n')
+
+class CheckValidator(object):
+    """Check QR code decoder and validator built once from config"""
+    def __init__(self, fns, interval):
+        self.fns = fns
+        self.interval = interval.total_seconds()
+
+    def validate(self, data, now):
+        """Decode QR payload and check time, type and fn in one pass
+
+        Field order does not matter and unknown fields are ignored.
+        Raises ValueError if the payload is not a check QR code.
+        """
+        fields = {}
+        for part in data.split('&'):
+            key, sep, value = part.partition('=')
+            if sep:
+                fields[key] = value
+        for key in QR_FIELDS:
+            if key not in fields:
+                raise ValueError('no field {} in {}'.format(key, data))
+        result = R_OK
+        ch_date = parse_qr_date(fields['t'])
+        if ch_date is None or now - ch_date > self.interval:
+            result = result | R_FAIL_TIME
+        ch_fn = to_int(fields['fn'])
+        label = self.fns.get(ch_fn)
+        if label is None:
+            result = result | R_FAIL_FN
+        ch_t = to_int(fields['n'])
+        if ch_t != 1:
+            result = result | R_FAIL_TYPE
+        row = (int(now), result, ch_date, parse_kop(fields['s']), ch_fn, to_int(fields['i']), to_int(fields['fp']), ch_t)
+        try:
+            raw = None if check_payload(*row[2:]) == data else data
+        except TypeError:
+            raw = data
+        return Check(*row, raw=raw, s=fields['s'], fp=fields['fp'], label=label)
+
+def parse_qr_date(value):
+    """Epoch seconds from QR date 'YYYYMMDDTHHMM[SS]' (minute precision), None if invalid"""
+    if len(value) < 13 or value[8] != 'T' or not (value[:8] + value[9:13]).isdigit():
+        return None
+    month, day, hour, minute = int(value[4:6]), int(value[6:8]), int(value[9:11]), int(value[11:13])
+    if not (1 <= month <= 12 and 1 <= day <= 31 and hour < 24 and minute < 60):
+        return None
+    try:
+        return int(time.mktime((int(value[0:4]), month, day, hour, minute, 0, 0, 0, -1)))
+    except (OverflowError, ValueError):
+        return None
+
+def read_fns(config, fn):
+    """Allowed fns from fnN options, labels are taken from comment lines above them"""
+    labels = {}
+    comment = ''
+    with open(fn, encoding='utf-8-sig') as f_cfg:
+        for line in f_cfg:
+            line = line.strip()
+            match = re.match(r'(fn\d+)\s*=', line)
+            if line.startswith('#'):
+                comment = line[1:].strip()
+                continue
+            if match:
+                labels[match.group(1)] = comment
+            comment = ''
+    fns = {}
+    for key, value in config.items('szpark'):
+        if re.match(r'fn\d+$', key) and to_int(value) is not None:
+            fns[int(value)] = labels.get(key) or key
+    return fns
+
+def to_int(value):
+    """Integer from string, None if it is not a number or does not fit sqlite INTEGER"""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if -DB_INT_MAX - 1 <= value <= DB_INT_MAX else None
+
+def to_epoch(value):
+    """Epoch seconds from datetime or its string form, None if empty"""
+    if isinstance(value, str):
+        if value == '':
+            return None
+        value = datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+    return int(time.mktime(value.timetuple()))
+
+def parse_kop(value):
+    """Sum in kopecks from '123.45' string, None if it is not a sum"""
+    rub, _, kop = value.partition('.')
+    if not rub.isdigit() or not (kop + '00')[:2].isdigit():
+        return None
+    return to_int(int(rub) * 100 + int((kop + '00')[:2]))
+
+def check_payload(ch_date, ch_sum, ch_fn, ch_fd, ch_fp, ch_t):
+    """Rebuild QR payload from typed check fields"""
+    return 't={}&s={}.{:02d}&fn={}&i={}&fp={}&n={}'.format(
+        time.strftime('%Y%m%dT%H%M', time.localtime(ch_date)), ch_sum // 100, ch_sum % 100, ch_fn, ch_fd, ch_fp, ch_t)
+
+def check_row(data, date, result, ch_date, ch_sum, ch_fn, ch_fd, ch_fp, ch_t):
+    """Typed row of checks table from decoded check fields"""
+    row = (to_epoch(date), result, to_epoch(ch_date), parse_kop(ch_sum),
+           to_int(ch_fn), to_int(ch_fd), to_int(ch_fp), to_int(ch_t))
+    try:
+        raw = None if check_payload(*row[2:]) == data else data
+    except TypeError:
+        raw = data
+    return row + (raw,)
+
+def migrate_checks(conn):
+    """Convert text cache table to compact checks table"""
+    query = 'SELECT COUNT(*), SUM(result = 0) FROM {} WHERE date >= ?'
+    t_start = time.perf_counter()
+    conn.execute(query.format('cache'), (str(datetime.now() - timedelta(days=31)),)).fetchone()
+    t_old = time.perf_counter() - t_start
+    rows = conn.execute('SELECT data, date, result, ch_date, ch_sum, ch_fn, ch_fd, ch_fp, ch_t FROM cache ORDER BY rowid')
+    conn.executemany(SQL_INSERT, (check_row(*row) for row in rows))
+    conn.execute('DROP TABLE cache')
+    t_start = time.perf_counter()
+    conn.execute(query.format('checks'), (int(time.time()) - 31 * 86400,)).fetchone()
+    t_new = time.perf_counter() - t_start
+    logging.info('Checks converted, last month query %.1f ms -> %.1f ms', t_old * 1000, t_new * 1000)
+
+# aggregate periods: stats and occupancy key and local time format of the period start
+STATS_PERIODS = (('h', '%Y-%m-%d %H'), ('d', '%Y-%m-%d'))
+# scan counts by period, fn and result, kept up to date by triggers on checks
+SQL_STATS = ['''CREATE TABLE IF NOT EXISTS stats(
+    period TEXT,
+    start TEXT,
+    ch_fn INTEGER,
+    result INTEGER,
+    count INTEGER,
+    PRIMARY KEY (period, start, ch_fn, result)) WITHOUT ROWID''',
+             '''CREATE TABLE IF NOT EXISTS occupancy(
+    period TEXT,
+    start TEXT,
+    peak INTEGER,
+    low INTEGER,
+    PRIMARY KEY (period, start)) WITHOUT ROWID''']
+# (trigger inserts take the conflict clause of the outer statement, so no INSERT OR IGNORE here)
+SQL_STATS_ADD = '''
+    INSERT INTO stats SELECT '{0}', strftime('{1}', NEW.date, 'unixepoch', 'localtime'), IFNULL(NEW.ch_fn, 0), NEW.result, 0
+        WHERE NOT EXISTS (SELECT 1 FROM stats WHERE period = '{0}' AND start = strftime('{1}', NEW.date, 'unixepoch', 'localtime')
+            AND ch_fn = IFNULL(NEW.ch_fn, 0) AND result = NEW.result);
+    UPDATE stats SET count = count + 1 WHERE period = '{0}' AND start = strftime('{1}', NEW.date, 'unixepoch', 'localtime')
+        AND ch_fn = IFNULL(NEW.ch_fn, 0) AND result = NEW.result;'''
+SQL_STATS_SUB = '''
+    UPDATE stats SET count = count - 1 WHERE period = '{0}' AND start = strftime('{1}', OLD.date, 'unixepoch', 'localtime')
+        AND ch_fn = IFNULL(OLD.ch_fn, 0) AND result = OLD.result;'''
+# occupancy peak and low of the periods of epoch ?1 for counter value ?2, queued on every change
+SQL_OCCUPANCY_UPDATE = [sql.format(*p) for p in STATS_PERIODS for sql in (
+    '''INSERT INTO occupancy SELECT '{0}', strftime('{1}', ?1, 'unixepoch', 'localtime'), ?2, ?2
+        WHERE NOT EXISTS (SELECT 1 FROM occupancy WHERE period = '{0}' AND start = strftime('{1}', ?1, 'unixepoch', 'localtime'))''',
+    '''UPDATE occupancy SET peak = MAX(peak, ?2), low = MIN(low, ?2)
+        WHERE period = '{0}' AND start = strftime('{1}', ?1, 'unixepoch', 'localtime')''')]
+SQL_STATS += [
+    'CREATE TRIGGER IF NOT EXISTS stats_insert AFTER INSERT ON checks BEGIN{}\nEND'.format(
+        ''.join(SQL_STATS_ADD.format(*p) for p in STATS_PERIODS)),
+    'CREATE TRIGGER IF NOT EXISTS stats_update AFTER UPDATE OF result ON checks WHEN OLD.result != NEW.result BEGIN{}\nEND'.format(
+        ''.join(SQL_STATS_SUB.format(*p) + SQL_STATS_ADD.format(*p) for p in STATS_PERIODS)),
+]
+
+def migrate_stats(conn):
+    """Build stats of checks already in base"""
+    t_start = time.perf_counter()
+    for period, fmt in STATS_PERIODS:
+        conn.execute('''INSERT INTO stats SELECT ?, strftime(?, date, 'unixepoch', 'localtime'), IFNULL(ch_fn, 0), result, COUNT(*)
+            FROM checks GROUP BY 2, 3, 4''', (period, fmt))
+    rows = conn.execute('SELECT COUNT(*) FROM stats').fetchone()[0]
+    logging.info('Built %d stats rows in %.1f ms', rows, (time.perf_counter() - t_start) * 1000)
+
+# base schema migrations, PRAGMA user_version is the number of applied ones,
+# an item is SQL statement or function called with connection
+DB_MIGRATIONS = [
+    # 1: initial schema
+    ['''CREATE TABLE IF NOT EXISTS cache(
+        data TEXT,
+        date TEXT,
+        result INT,
+        ch_date TEXT,
+        ch_sum TEXT,
+        ch_fn TEXT,
+        ch_fd TEXT,
+        ch_fp TEXT,
+        ch_t INT)''',
+     'CREATE INDEX IF NOT EXISTS data ON cache (data)',
+     'CREATE TABLE IF NOT EXISTS pc(value INT)'],
+    # 2: indexes for base page filters
+    ['CREATE INDEX IF NOT EXISTS {0} ON cache ({0})'.format(column)
+     for column in ('date', 'result', 'ch_fn', 'ch_fp', 'ch_sum')],
+    # 3: compact typed checks table
+    [SQL_CHECKS_TABLE.format(''), migrate_checks] +
+    ['CREATE INDEX IF NOT EXISTS checks_{0} ON checks ({0})'.format(column)
+     for column in ('date', 'result', 'ch_fn', 'ch_fp', 'ch_sum')],
+    # 4: hourly and daily aggregates
+    SQL_STATS + [migrate_stats],
+]
+
+class Storage(object):
+    """Owner of service base: schema migrations, pragmas and batched writer
+
+    All writes go through the queue and are committed by one thread in groups,
+    at most commit_interval seconds after the first statement of a group.
+    """
+    def __init__(self, dbfn, queue_size, commit_interval, wal=True):
+        self.dbfn = dbfn
+        self.commit_interval = commit_interval
+        self.queue = StageQueue('Write', queue_size)
+        self.wal = wal
+        self.conn = self.connect()
+        self.commits = 0
+        self.rows = 0
+        self.last_batch = 0
+
+    def connect(self):
+        """Open writer connection"""
+        conn = sqlite3.connect(self.dbfn, check_same_thread=False, cached_statements=64)
+        if self.wal:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=-8192')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def reconnect(self):
+        """Replace connection of a stalled writer, its open transaction is abandoned"""
+        conn, self.conn = self.conn, self.connect()
+        conn.close()
+
+    def migrate(self):
+        """Apply schema migrations the base does not have yet"""
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version == len(DB_MIGRATIONS):
+            return
+        size = self.size()
+        for n in range(version, len(DB_MIGRATIONS)):
+            with self.conn:
+                for sql in DB_MIGRATIONS[n]:
+                    if callable(sql):
+                        sql(self.conn)
+                    else:
+                        self.conn.execute(sql)
+                self.conn.execute('PRAGMA user_version={}'.format(n + 1))
+            logging.info('Base migrated to version %d', n + 1)
+        self.conn.execute('VACUUM')
+        if self.wal:
+            # VACUUM output is in the WAL until checkpoint, size after it would count the base twice
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        logging.info('Base size %d KiB -> %d KiB', size / 1024, self.size() / 1024)
+
+    def size(self):
+        """Base size on disk including WAL (bytes)"""
+        return sum(os.path.getsize(fn) for fn in (self.dbfn, self.dbfn + '-wal') if os.path.exists(fn))
+
+    def write_loop(self):
+        """Writer thread: collect statements from queue and commit them in groups"""
+        while True:
+            supervisor.heartbeat()
+            try:
+                batch = [self.queue.get(timeout=SUP_BEAT_INTERVAL)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < DB_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.write(batch)
+
+    def write(self, batch):
+        """Write statements in one transaction
+
+        (None, event) items are flush marks, (function, args) items are
+        called after the transaction is committed.
+        """
+        statements = [item for item in batch if isinstance(item[0], str)]
+        try:
+            with metrics.timer('szpark_db_write_seconds'), self.conn:
+                for sql, items in groupby(statements, key=lambda item: item[0]):
+                    self.conn.executemany(sql, [params for _, params in items])
+            self.commits = self.commits + 1
+            self.rows = self.rows + len(statements)
+            self.last_batch = len(statements)
+            metrics.inc('szpark_db_rows_total', len(statements))
+        except (sqlite3.Error, OverflowError, ValueError) as e:
+            logging.error('Failed to write %d statements to base, writing one by one: %s', len(statements), e)
+            self.write_each(statements)
+        for fn, params in batch:
+            if fn is None:
+                params.set()
+            elif callable(fn):
+                try:
+                    fn(*params)
+                except sqlite3.Error as e:
+                    logging.error('Base job %s failed: %s', fn.__name__, e)
+
+    def write_each(self, statements):
+        """Write statements in own transactions, so one bad row does not drop the others"""
+        failed = 0
+        for sql, params in statements:
+            try:
+                with self.conn:
+                    self.conn.execute(sql, params)
+            except (sqlite3.Error, OverflowError, ValueError) as e:
+                failed = failed + 1
+                metrics.inc('szpark_db_errors_total')
+                logging.error('Dropped statement %s %r: %s', sql.split('(')[0], params, e)
+        self.commits = self.commits + 1
+        self.rows = self.rows + len(statements) - failed
+        self.last_batch = len(statements) - failed
+        metrics.inc('szpark_db_rows_total', len(statements) - failed)
+
+    def archive(self, before):
+        """Move checks scanned before epoch to monthly archive bases"""
+        month = 'strftime("%Y-%m", {0}date, "unixepoch", "localtime")'
+        months = self.conn.execute('SELECT DISTINCT {} FROM checks WHERE date < ?'.format(month.format('')),
+                                   (before,)).fetchall()
+        where = 'WHERE {0}date < ? AND {1} = ?'.format('{0}', month)
+        for (name,) in months:
+            self.conn.execute('ATTACH DATABASE ? AS archive', (self.dbfn.replace('.sqlite', '_{}.sqlite'.format(name)),))
+            try:
+                with self.conn:
+                    self.conn.execute(SQL_CHECKS_TABLE.format('archive.'))
+                    count = self.conn.execute('SELECT COUNT(*) FROM main.checks ' + where.format(''),
+                                              (before, name)).fetchone()[0]
+                    # rows left by an interrupted run are already there, anything else with the same id is not
+                    self.conn.execute('INSERT OR IGNORE INTO archive.checks SELECT * FROM main.checks ' + where.format(''),
+                                      (before, name))
+                    copied = self.conn.execute(
+                        'SELECT COUNT(*) FROM main.checks m JOIN archive.checks a ON a.id = m.id AND a.date = m.date '
+                        + where.format('m.'), (before, name)).fetchone()[0]
+                    if copied != count:
+                        raise sqlite3.IntegrityError('{} of {} checks copied'.format(copied, count))
+                    self.conn.execute('DELETE FROM main.checks ' + where.format(''), (before, name))
+                logging.info('Archived %d checks of %s', count, name)
+            except sqlite3.IntegrityError as e:
+                logging.error('Checks of %s not archived, kept in base: %s', name, e)
+            finally:
+                self.conn.execute('DETACH DATABASE archive')
+
+    def load(self, rows):
+        """Bulk insert checks rows in IMPORT_BATCH transactions (not through the writer queue)
+
+        Returns number of rows inserted.
+        """
+        rows = iter(rows)
+        count = 0
+        while True:
+            batch = list(islice(rows, IMPORT_BATCH))
+            if not batch:
+                return count
+            with self.conn:
+                self.conn.executemany(SQL_INSERT, batch)
+            count = count + len(batch)
+            logging.debug('Imported %d checks', count)
+
+    def flush(self):
+        """Wait until everything queued so far is committed"""
+        event = threading.Event()
+        self.queue.put((None, event))
+        event.wait()
+
+    def status(self):
+        """Writer counters as text"""
+        return '{} rows in {} commits (last batch: {}), queue {}, size {} KiB'.format(
+            self.rows, self.commits, self.last_batch, self.queue.status(), self.size() // 1024)
+
+class ReadPool(object):
+    """Pool of read-only sqlite connections for web interface"""
+    def __init__(self, dbfn, size):
+        self.uri = Path(dbfn).resolve().as_uri() + '?mode=ro'
+        self.pool = queue.Queue()
+        for _ in range(size):
+            self.pool.put(sqlite3.connect(self.uri, uri=True, check_same_thread=False))
+
+    @contextmanager
+    def connection(self):
+        """Borrow connection from pool"""
+        conn = self.pool.get()
+        try:
+            yield conn
+        finally:
+            conn.rollback()
+            self.pool.put(conn)
+
+def export_chunks(connection, date1=None, date2=None):
+    """Checks rows scanned in [date1, date2) epoch range as lists of up to EXPORT_CHUNK rows
+
+    connection() is a context manager giving a connection. It is borrowed for
+    one chunk at a time (keyset pagination on id), so a long download keeps
+    no read transaction open.
+    """
+    where = ''
+    params = []
+    if date1 is not None:
+        where = where + ' AND date >= ?'
+        params.append(date1)
+    if date2 is not None:
+        where = where + ' AND date < ?'
+        params.append(date2)
+    sql = 'SELECT id, {} FROM checks WHERE id > ?{} ORDER BY id LIMIT {}'.format(
+        ', '.join(EXPORT_FIELDS), where, EXPORT_CHUNK)
+    last_id = 0
+    while True:
+        with connection() as conn:
+            rows = conn.execute(sql, [last_id] + params).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield [row[1:] for row in rows]
+        if len(rows) < EXPORT_CHUNK:
+            return
+
+def export_range(date_from, date_to):
+    """Epoch [start, end) range from optional 'YYYY-MM-DD' dates, end date included"""
+    date1 = to_epoch(datetime.strptime(date_from, '%Y-%m-%d')) if date_from else None
+    date2 = to_epoch(datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)) if date_to else None
+    return date1, date2
+
+def export_csv(chunks):
+    """CSV with header line, empty cells for NULL"""
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(EXPORT_FIELDS)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield out.getvalue().encode('utf-8')
+        out.seek(0)
+        out.truncate()
+    yield out.getvalue().encode('utf-8')
+
+def export_ndjson(chunks):
+    """One JSON object per line"""
+    for rows in chunks:
+        yield ''.join(json.dumps(OrderedDict(zip(EXPORT_FIELDS, row)), ensure_ascii=False) + '\n'
+                      for row in rows).encode('utf-8')
+
+def column_delta(values):
+    """Differences from the previous value, NULL stays NULL and is skipped"""
+    out = []
+    prev = 0
+    for value in values:
+        if value is None:
+            out.append(None)
+        else:
+            out.append(value - prev)
+            prev = value
+    return out
+
+def column_undelta(values):
+    """Values back from column_delta output"""
+    out = []
+    prev = 0
+    for value in values:
+        if value is None:
+            out.append(None)
+        else:
+            prev = prev + value
+            out.append(prev)
+    return out
+
+def export_columns(chunks):
+    """Gzip compressed JSON lines, each one a block of column arrays
+
+    Block: {"n": rows, "<field>": [values], ...}, EXPORT_DELTA columns hold
+    differences so that the close dates and numbers of one site compress well.
+    """
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for rows in chunks:
+        block = OrderedDict([('n', len(rows))])
+        for name, values in zip(EXPORT_FIELDS, zip(*rows)):
+            block[name] = column_delta(values) if name in EXPORT_DELTA else values
+        data = gz.compress(json.dumps(block, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n')
+        if data:
+            yield data
+    yield gz.flush()
+
+def import_row(values):
+    """Typed checks row from imported field values (EXPORT_FIELDS order)"""
+    row = [to_int(value) for value in values]
+    row[-1] = values[-1] or None
+    return row
+
+def import_csv(f_in):
+    """Checks rows from CSV with header line (binary file)"""
+    reader = csv.reader(io.TextIOWrapper(f_in, encoding='utf-8-sig', newline=''))
+    header = next(reader, [])
+    try:
+        index = [header.index(name) for name in EXPORT_FIELDS]
+    except ValueError:
+        raise ValueError('CSV header must have columns {}'.format(', '.join(EXPORT_FIELDS)))
+    for record in reader:
+        if record:
+            yield import_row([record[i] for i in index])
+
+def import_ndjson(f_in):
+    """Checks rows from JSON lines (binary file)"""
+    for line in io.TextIOWrapper(f_in, encoding='utf-8-sig'):
+        if line.strip():
+            item = json.loads(line)
+            yield import_row([item.get(name) for name in EXPORT_FIELDS])
+
+def import_columns(f_in):
+    """Checks rows from gzip compressed column blocks (binary file)"""
+    for line in gzip.GzipFile(fileobj=f_in):
+        block = json.loads(line.decode('utf-8'))
+        columns = []
+        for name in EXPORT_FIELDS:
+            values = block.get(name) or [None] * block['n']
+            columns.append(column_undelta(values) if name in EXPORT_DELTA else values)
+        for row in zip(*columns):
+            yield import_row(row)
+
+# export file formats: mimetype, file extension, writer and reader
+EXPORT_FORMATS = OrderedDict([
+    ('csv', ('text/csv', '.csv', export_csv, import_csv)),
+    ('ndjson', ('application/x-ndjson', '.ndjson', export_ndjson, import_ndjson)),
+    ('columns', ('application/gzip', '.cols.gz', export_columns, import_columns)),
+])
+
+def export_format(fn, fmt=None):
+    """Export format by name or file extension (default csv)"""
+    if fmt:
+        return fmt
+    for name, (_, ext, _, _) in EXPORT_FORMATS.items():
+        if fn.endswith(ext):
+            return name
+    return 'csv'
+
+class ModbusError(Exception):
+    """Modbus command failed or controller is not reachable"""
+
+class ModbusSession(object):
+    """Shared modbus TCP session, commands are run one by one from a queue"""
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        # created by the session thread, so pymodbus import and connect do not hold up startup
+        self.client = None
+        self.queue = queue.Queue()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.backoff = MB_BACKOFF_MIN
+        self.retry_at = 0
+        self.requests = 0
+        self.errors = 0
+        self.connects = 0
+        self.rtt = 0
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, command, key=None, op=None):
+        """Queue command(client), return Future
+
+        Commands with the same key that are still waiting in the queue are
+        coalesced into one and share the result. op names the command in
+        metrics (key by default).
+        """
+        with self.lock:
+            if key is not None and key in self.pending:
+                return self.pending[key]
+            future = Future()
+            if key is not None:
+                self.pending[key] = future
+        self.queue.put((command, key, op or key or 'command', future))
+        return future
+
+    def call(self, command, key=None, op=None):
+        """Run command(client) and wait for its result"""
+        try:
+            return self.submit(command, key, op).result(MB_CALL_TIMEOUT)
+        except FutureTimeout:
+            raise ModbusError('command timed out')
+
+    def connect(self):
+        """Make sure the session is connected, reconnecting with backoff"""
+        if self.client.is_socket_open():
+            return True
+        if time.monotonic() < self.retry_at:
+            return False
+        if self.client.connect():
+            if self.connects:
+                logging.info('Modbus reconnected')
+            self.connects = self.connects + 1
+            self.backoff = MB_BACKOFF_MIN
+            return True
+        logging.info('Modbus connect failed, retry in %.1f s', self.backoff)
+        metrics.inc('szpark_modbus_connect_failures_total')
+        self.retry_at = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, MB_BACKOFF_MAX)
+        return False
+
+    def probe(self):
+        """Idle health check: read one register, so a half-open socket is found before the next command"""
+        if self.client.is_socket_open():
+            try:
+                result = self.client.read_input_registers(g_cfg['mbcreg_in'], 1, unit=1)
+                if result.isError():
+                    raise ModbusError(str(result))
+                return
+            except Exception as e: # pylint: disable=broad-except
+                logging.info('Modbus health check failed: %s', e)
+                self.errors = self.errors + 1
+                metrics.inc('szpark_modbus_errors_total', op='health')
+                self.client.close()
+        self.connect()
+
+    def run(self):
+        """Session thread: connect at once, then execute queued commands"""
+        from pymodbus.client.sync import ModbusTcpClient # pylint: disable=import-outside-toplevel
+        self.client = ModbusTcpClient(self.host, port=self.port)
+        self.connect()
+        while True:
+            try:
+                command, key, op, future = self.queue.get(timeout=MB_HEALTH_INTERVAL)
+            except queue.Empty:
+                self.probe()
+                continue
+            with self.lock:
+                if key is not None:
+                    self.pending.pop(key, None)
+            if not future.set_running_or_notify_cancel():
+                continue
+            self.requests = self.requests + 1
+            try:
+                if not self.connect():
+                    raise ModbusError('not connected')
+                t_start = time.perf_counter()
+                result = command(self.client)
+                if hasattr(result, 'isError') and result.isError():
+                    raise ModbusError(str(result))
+                rtt = time.perf_counter() - t_start
+                metrics.observe('szpark_modbus_command_seconds', rtt, op=op)
+                self.rtt = self.rtt * 0.9 + rtt * 1000 * 0.1
+                future.set_result(result)
+            except Exception as e: # pylint: disable=broad-except
+                self.errors = self.errors + 1
+                metrics.inc('szpark_modbus_errors_total', op=op)
+                self.client.close()
+                future.set_exception(e if isinstance(e, ModbusError) else ModbusError(str(e)))
+
+    def status(self):
+        """Session state and metrics as html"""
+        if self.client is not None and self.client.is_socket_open():
+            state = '<font color="#00AA00">connected</font>'
+        else:
+            state = '<font color="#AA0000">disconnected</font>'
+        rate = self.errors * 100.0 / self.requests if self.requests else 0
+        return '{}, rtt {:.1f} ms, errors {}/{} ({:.1f}%), connects {}, queue {}'.format(
+            state, self.rtt, self.errors, self.requests, rate, self.connects, self.queue.qsize())
+
+class PulseScheduler(object):
+    """Switches coils on and off after pulse time from a single thread"""
+    def __init__(self, mb):
+        self.mb = mb
+        self.cond = threading.Condition()
+        # coil -> [on time, off deadline, duration]
+        self.pulses = {}
+        self.count = 0
+        self.merged = 0
+        self.last = 0
+        self.longest = 0
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def pulse(self, coil, duration):
+        """Switch coil on for duration seconds without waiting
+
+        A pulse requested while the coil is still on extends the running one.
+        """
+        now = time.monotonic()
+        with self.cond:
+            if coil in self.pulses:
+                self.pulses[coil][1] = max(self.pulses[coil][1], now + duration)
+                self.merged = self.merged + 1
+                self.cond.notify()
+                return
+            self.pulses[coil] = [now, now + duration, duration]
+            self.count = self.count + 1
+            self.cond.notify()
+            self.switch_on(coil, True)
+
+    def switch_on(self, coil, retry):
+        """Queue coil on write"""
+        future = self.mb.submit(lambda mbc: mbc.write_coil(coil, True, unit=1), op='coil_on')
+        future.add_done_callback(lambda f: self.on_done(coil, f, retry))
+
+    def on_done(self, coil, future, retry=False):
+        """Coil is on: count pulse time from now
+
+        A failed write is retried once, the session reconnects after an error
+        (the first write on a socket the controller dropped fails).
+        """
+        if future.exception() is not None:
+            with self.cond:
+                if retry and coil in self.pulses:
+                    logging.info('Failed to switch coil %d on, retrying: %s', coil, future.exception())
+                    self.switch_on(coil, False)
+                    return
+            logging.info('Failed to switch coil %d on: %s', coil, future.exception())
+            return
+        now = time.monotonic()
+        with self.cond:
+            if coil in self.pulses:
+                self.pulses[coil][0] = now
+                self.pulses[coil][1] = max(self.pulses[coil][1], now + self.pulses[coil][2])
+                self.cond.notify()
+
+    def off_done(self, coil, t_on, future):
+        """Coil is off: record pulse time or retry if write failed"""
+        now = time.monotonic()
+        if future.exception() is not None:
+            logging.info('Failed to switch coil %d off: %s', coil, future.exception())
+            with self.cond:
+                if coil not in self.pulses:
+                    self.pulses[coil] = [t_on, now + PULSE_RETRY, 0]
+                    self.cond.notify()
+            return
+        self.last = now - t_on
+        self.longest = max(self.longest, self.last)
+        logging.info('Coil %d closed after %.2f s', coil, self.last)
+
+    def run(self):
+        """Scheduler thread: switch off coils whose pulse time is over"""
+        while True:
+            with self.cond:
+                now = time.monotonic()
+                due = [(coil, p[0]) for coil, p in self.pulses.items() if p[1] <= now]
+                if not due:
+                    if self.pulses:
+                        self.cond.wait(min(p[1] for p in self.pulses.values()) - now)
+                    else:
+                        self.cond.wait()
+                    continue
+                # off writes are queued before the lock is released, so a new pulse
+                # of the same coil always queues its on write after them
+                for coil, t_on in due:
+                    del self.pulses[coil]
+                    future = self.mb.submit(lambda mbc, coil=coil: mbc.write_coil(coil, False, unit=1), op='coil_off')
+                    future.add_done_callback(lambda f, coil=coil, t_on=t_on: self.off_done(coil, t_on, f))
+
+    def status(self):
+        """Pulse counters and timing as text"""
+        return '{} (merged: {}), last open {:.2f} s, longest {:.2f} s'.format(
+            self.count, self.merged, self.last, self.longest)
+
+class OnlineCache(object):
+    """LRU cache of online check answers with time to live"""
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return cached answer or None if missing or expired"""
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or time.monotonic() - item[1] > self.ttl:
+                if item is not None:
+                    del self.items[key]
+                self.misses = self.misses + 1
+                return None
+            self.items.move_to_end(key)
+            self.hits = self.hits + 1
+            return item[0]
+
+    def put(self, key, value):
+        """Store answer, evicting least recently used one if full"""
+        with self.lock:
+            self.items[key] = (value, time.monotonic())
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def status(self):
+        """Cache size and hit counters as text"""
+        return '{}/{} (hits: {}, misses: {})'.format(len(self.items), self.size, self.hits, self.misses)
 
 @auth.get_password
 def get_pw(username):
@@ -37,111 +1459,162 @@ def get_pw(username):
         return users.get(username)
     return None
 
-# global variable
-g_cfg = {}
+# global variables: read-only config snapshot (swapped on reload) and runtime state
+g_cfg = MappingProxyType({})
+g_state = {'cfg_reloads': 0, 'cfg_error': '', 'sampler': Sampler(), 'live': Broadcaster(), 'startup': OrderedDict()}
+# requests module, imported by online_init only when online checks are enabled
+requests = None
 
 @app.route('/', methods=['POST', 'GET'])
 @auth.login_required
 def www_root():
-    """Function for Web Interface (status page)"""
+    """Function for Web Interface (status page, kept up to date by /events)"""
     tpl = """
     <html>
     <table>
-    <tr><td>watchdog thread:</td><td>{}</td></tr>
-    <tr><td>scanning thread:</td><td>{}</td></tr>
-    <tr><td>parking counter thread:</td><td>{}</td></tr>
-    <tr><td>parking counter value:</td><td>{}</td></tr>
-    <tr><td>remaining parking spaces:</td><td>{}</td></tr>
+    <tr><td>watchdog thread:</td><td id="watch_status">{}</td></tr>
+    <tr><td>scanning threads:</td><td id="scan_status">{}</td></tr>
+    {}
+    <tr><td>last scan:</td><td id="last_scan"></td></tr>
+    <tr><td>parking counter thread:</td><td id="pc_status">{}</td></tr>
+    <tr><td>parking counter value:</td><td id="pc_value">{}</td></tr>
+    <tr><td>remaining parking spaces:</td><td id="pc_remaining">{}</td></tr>
+    <tr><td>parking counter reads/writes:</td><td>{}</td></tr>
+    <tr><td>validation threads:</td><td id="valid_status">{}</td></tr>
+    <tr><td>writer thread:</td><td id="write_status">{}</td></tr>
+    <tr><td>supervised threads:</td><td id="workers">{}</td></tr>
+    <tr><td>last restart:</td><td id="last_restart">{}</td></tr>
+    <tr><td>scan queue:</td><td>{}</td></tr>
+    <tr><td>base writer:</td><td>{}</td></tr>
+    <tr><td>modbus session:</td><td>{}</td></tr>
+    <tr><td>barrier pulses:</td><td>{}</td></tr>
+    <tr><td>multiple use index:</td><td>{}</td></tr>
+    <tr><td>online cache:</td><td>{}</td></tr>
+    <tr><td>online recheck queue:</td><td>{}</td></tr>
+    <tr><td>last scan latency:</td><td id="scan_latency">{:.1f} ms</td></tr>
+    <tr><td>config:</td><td>{}</td></tr>
+    <tr><td>startup:</td><td>{}</td></tr>
     <tr><td valign="top">new parking counter value:</td>
     <td><form action="/" method="post">
         <input name="count" type="text" size="2">
         <input type="submit" value="ok"/>
     </form></td><tr>
-    <tr><td><a href="/base">base page</a></td><td><a href="/log">log page</a></td></tr>
+    <tr><td><a href="/base">base page</a></td><td><a href="/log">log page</a> (<a href="/log?live=1">live</a>)</td></tr>
+    <tr><td><a href="/report?format=csv">today report</a></td><td><a href="/report/occupancy?period=hour&amp;format=csv">today occupancy</a></td></tr>
+    <tr><td><a href="/export">export checks</a></td><td>(<a href="/export?format=ndjson">ndjson</a>, <a href="/export?format=columns">columns</a>)</td></tr>
     <tr><td><a href="/opensesame">open parking</a></td><td><a href="/">refresh</a></td></tr>
+    <tr><td><a href="/reload">reload config</a></td><td><a href="/metrics">metrics</a> (<a href="/profile">profile</a>)</td></tr>
     </table>
+    {}
     </html>
     """
     if request.method == 'POST':
         pc_new_value = int(request.form['count'])
-        g_cfg['pc'] = pc_new_value
-        update_pc()
-        pc_reset()
-    if g_cfg['watchdog']:
-        if g_cfg['th_watch'].is_alive():
-            watch_status = '<font color="#00AA00">alive</font>'
-        else:
-            watch_status = '<font color="#AA0000">dead</font>'
+        with pc_lock:
+            g_state['pc'] = pc_new_value
+            update_pc()
+            pc_reset()
+            update_occupancy()
+            publish_pc()
+    health = thread_health()
+    lane_rows = ''.join(
+        '<tr><td>lane {0} ({1}):</td><td><span id="lane_{0}">{2}</span> <a href="/opensesame?lane={0}">open</a></td></tr>'.format(
+            escape(lane.name), escape(lane.cfg.com), lane.status()) for lane in list(g_state['lanes'].values()))
+    if g_cfg['multiple']:
+        dup_index = '<font color="#AAAAAA">disabled</font>'
     else:
-        watch_status = '<font color="#AAAAAA">disabled</font>'
-    if g_cfg['th_scan'].is_alive():
-        scan_status = '<font color="#00AA00">alive</font>'
+        dup_index = g_state['dup_index'].status()
+    if g_cfg['online']:
+        online_cache = g_state['online_cache'].status()
+        online_queue = g_state['q_online'].status()
     else:
-        scan_status = '<font color="#AA0000">dead</font>'
+        online_cache = '<font color="#AAAAAA">disabled</font>'
+        online_queue = online_cache
     if g_cfg['pc_enable']:
-        if g_cfg['th_pc'].is_alive():
-            pc_status = '<font color="#00AA00">alive</font>'
-        else:
-            pc_status = '<font color="#AA0000">dead</font>'
-        pc_value = g_cfg['pc']
+        pc_value = g_state['pc']
         pc_remaining = g_cfg['pc_capacity'] - pc_value
+        pc_rates = '{:.2f}/s, {:.3f}/s'.format(g_state['pc_reads'].rate(), g_state['pc_writes'].rate())
     else:
-        pc_status = '<font color="#AAAAAA">disabled</font>'
         pc_value = 0
         pc_remaining = 0
-    return tpl.format(watch_status, scan_status, pc_status, pc_value, pc_remaining)
+        pc_rates = health['pc_status']
+    cfg_status = 'loaded {} (reloads: {})'.format(
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(g_state['cfg_time'])), g_state['cfg_reloads'])
+    if g_state['cfg_error']:
+        cfg_status += ' <font color="#AA0000">last reload failed: {}</font>'.format(escape(g_state['cfg_error']))
+    return tpl.format(health['watch_status'], health['scan_status'], lane_rows, health['pc_status'], pc_value,
+                      pc_remaining, pc_rates, health['valid_status'], health['write_status'], health['workers'],
+                      health['last_restart'], g_state['q_scan'].status(),
+                      g_state['db'].status(), g_state['mb'].status(), g_state['pulse'].status(), dup_index, online_cache,
+                      online_queue, g_state.get('scan_latency', 0), cfg_status, startup_status(), STATUS_LIVE_JS)
+
+def alive_status(alive, total=None):
+    """Thread liveness as html"""
+    if total is None:
+        if alive:
+            return '<font color="#00AA00">alive</font>'
+        return '<font color="#AA0000">dead</font>'
+    if alive == total:
+        return '<font color="#00AA00">{} alive</font>'.format(alive)
+    return '<font color="#AA0000">{}/{} alive</font>'.format(alive, total)
+
+def thread_health():
+    """Status page thread cells as html by element id"""
+    disabled = '<font color="#AAAAAA">disabled</font>'
+    lanes = list(g_state['lanes'].values())
+    health = OrderedDict()
+    health['watch_status'] = alive_status(g_state['th_watch'].is_alive()) if g_cfg['watchdog'] else disabled
+    health['scan_status'] = alive_status(len([lane for lane in lanes if supervisor.alive('scan:' + lane.name)]),
+                                         len(lanes))
+    health['pc_status'] = alive_status(supervisor.alive('pc')) if g_cfg['pc_enable'] else disabled
+    valid = range(g_state['valid_workers'])
+    health['valid_status'] = alive_status(len([i for i in valid if supervisor.alive('valid:{}'.format(i))]), len(valid))
+    health['write_status'] = alive_status(supervisor.alive('write'))
+    health['workers'] = supervisor.status()
+    health['last_restart'] = supervisor.last_restart()
+    return health
+
+def publish_pc():
+    """Send parking counter to live status clients"""
+    g_state['live'].publish('pc', {'value': g_state['pc'], 'remaining': g_cfg['pc_capacity'] - g_state['pc']})
+
+def live_response(stream):
+    """Server-sent events response holding one of live_clients slots until it is closed
+
+    Without a free slot the client gets 503 and falls back to page reloads,
+    so streams never take the web server threads of ordinary requests.
+    """
+    if not g_state['live_slots'].acquire(blocking=False):
+        stream.close()
+        return Response('too many live clients\n', status=503, mimetype='text/plain')
+    response = Response(stream, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    response.call_on_close(g_state['live_slots'].release)
+    return response
+
+@app.route('/events')
+@auth.login_required
+def www_events():
+    """Function for Web Interface (live status as server-sent events)"""
+    return live_response(g_state['live'].stream())
 
 @app.route('/base', methods=['POST', 'GET'])
 @auth.login_required
 def www_base():
     """Function for Web Interface (base page)"""
-    result_ok = ''
-    multiple_use = ''
-    time_exceed = ''
-    online_failed = ''
-    invalid_type = ''
-    invalid_fn = ''
-    ch_sum = ''
-    ch_fn = ''
-    ch_fd = ''
-    ch_fp = ''
-    ch_t = ''
-    date1 = ''
-    date2 = ''
-    if request.method == 'POST':
-        if request.form.get('result_ok'):
-            result_ok = 'checked'
-        if request.form.get('multiple_use'):
-            multiple_use = 'checked'
-        if request.form.get('time_exceed'):
-            time_exceed = 'checked'
-        if request.form.get('online_failed'):
-            online_failed = 'checked'
-        if request.form.get('invalid_type'):
-            invalid_type = 'checked'
-        if request.form.get('invalid_fn'):
-            invalid_fn = 'checked'
-        ch_sum = request.form['ch_sum']
-        if (ch_sum[-3:-2] != '.') and (ch_sum != ''):
-            ch_sum = ch_sum + '.00'
-        date1 = request.form['date1']
-        date2 = request.form['date2']
-        ch_fn = request.form['ch_fn']
-        ch_fd = request.form['ch_fd']
-        ch_fp = request.form['ch_fp']
-        ch_t = request.form['ch_t']
-    if date1 == '':
-        date1 = datetime.strftime(datetime.now(), "%Y-%m-%d")
-    dt1 = ''
-    try:
-        dt1 = datetime.strptime(date1 + ' 00:00', '%Y-%m-%d %H:%M')
-    except ValueError:
-        pass
-    dt2 = ''
-    try:
-        dt2 = datetime.strptime(date2 + ' 23:59', '%Y-%m-%d %H:%M')
-    except ValueError:
-        pass
+    flt = {}
+    for name in ('result_ok', 'multiple_use', 'time_exceed', 'online_failed', 'invalid_type', 'invalid_fn'):
+        flt[name] = 'checked' if request.values.get(name) else ''
+    for name in ('date1', 'date2', 'ch_sum', 'ch_fn', 'ch_fd', 'ch_fp', 'ch_t'):
+        flt[name] = request.values.get(name, '')
+    if (flt['ch_sum'][-3:-2] != '.') and (flt['ch_sum'] != ''):
+        flt['ch_sum'] = flt['ch_sum'] + '.00'
+    if flt['date1'] == '':
+        flt['date1'] = datetime.strftime(datetime.now(), "%Y-%m-%d")
+    # keyset pagination: rows older than (before, before_id)
+    before = request.values.get('before', 0, type=int)
+    before_id = request.values.get('before_id', 0, type=int)
+    num = request.values.get('num', 1, type=int)
+    where, params = base_filter(flt)
     html = """
     <html>
     <table border=1">
@@ -154,9 +1627,9 @@ def www_base():
     <th>check fd</th>
     <th>check fp</th>
     <th>check type</th>
-    <tr><td><form action="/base" method="post"></td>
+    <tr><td><form action="/base" method="get"></td>
     <td>
-    <input type="date" name="date1" size="2" value={}> - <input type="date" name="date2" size="2" value={}>
+    <input type="date" name="date1" size="2" value="{}"> - <input type="date" name="date2" size="2" value="{}">
     </td>
     <td>
     <input type="checkbox" name="result_ok" id="id_result_ok" {}><label for="id_result_ok">ok</label>
@@ -167,100 +1640,393 @@ def www_base():
     <input type="checkbox" name="invalid_fn" id="id_invalid_fn" {}><label for="id_invalid_fn">invalid fn</label>    
     </td>
     <td></td>
-    <td><input name="ch_sum" type="text" size="6" value={}></td>
-    <td><input name="ch_fn" type="text" value={}></td>
-    <td><input name="ch_fd" type="text" size="4" value={}></td>
-    <td><input name="ch_fp" type="text" size="7" value={}></td>
-    <td><input name="ch_t" type="text" size="1" value={}>
+    <td><input name="ch_sum" type="text" size="6" value="{}"></td>
+    <td><input name="ch_fn" type="text" value="{}"></td>
+    <td><input name="ch_fd" type="text" size="4" value="{}"></td>
+    <td><input name="ch_fp" type="text" size="7" value="{}"></td>
+    <td><input name="ch_t" type="text" size="1" value="{}">
     <input type="submit" value="ok"/></form></td></tr>""".format(
-        date1, date2, result_ok, multiple_use, time_exceed, online_failed, invalid_type, invalid_fn, ch_sum, ch_fn, ch_fd, ch_fp, ch_t)
-    dbfn = __file__.replace('.py', '.sqlite')
-    conn = sqlite3.connect(dbfn)
-    cursor = conn.cursor()
-    num = 1
-    sql = 'SELECT strftime("%d.%m.%Y %H:%M:%S", date) , result, strftime("%d.%m.%Y %H:%M:%S", ch_date), ch_sum, ch_fn, ch_fd, ch_fp, ch_t FROM cache'
-    s_and = ''
-    if str(dt1) + str(dt2) + result_ok + multiple_use + time_exceed + online_failed + invalid_type + invalid_fn + ch_sum + ch_fn + ch_fd + ch_fp + ch_t != '':
-        sql = sql + ' WHERE'
-        if result_ok == 'checked':
-            sql, s_and = add_sql_param(sql, 'result', R_OK, s_and)
-        if multiple_use == 'checked':
-            sql, s_and = add_sql_param(sql, 'result', R_FAIL_MULTI, s_and)
-        if time_exceed == 'checked':
-            sql, s_and = add_sql_param(sql, 'result', R_FAIL_TIME, s_and)
-        if online_failed == 'checked':
-            sql, s_and = add_sql_param(sql, 'result', R_FAIL_ONLINE, s_and)
-        if invalid_type == 'checked':
-            sql, s_and = add_sql_param(sql, 'result', R_FAIL_TYPE, s_and)
-        if invalid_fn == 'checked':
-            sql, s_and = add_sql_param(sql, 'result', R_FAIL_FN, s_and)
-        sql, s_and = add_sql_param(sql, 'ch_sum', ch_sum, s_and)
-        sql, s_and = add_sql_param(sql, 'ch_fn', ch_fn, s_and)
-        sql, s_and = add_sql_param(sql, 'ch_fd', ch_fd, s_and)
-        sql, s_and = add_sql_param(sql, 'ch_fp', ch_fp, s_and)
-        sql, s_and = add_sql_param(sql, 'ch_t', ch_t, s_and)
-        sql, s_and = add_sql_param(sql, 'date', (dt1, dt2), s_and)
-
-    sql = sql + ' ORDER BY datetime(date) DESC'
-    for row in cursor.execute(sql):
-        html = html + '<tr><td>'
-        html = html + '{}</td><td>'.format(num)
-        html = html + '{}</td><td>'.format(row[0])
-        html = html + '{}</td><td>'.format(result_decode(row[1], True))
-        html = html + '{}</td><td>'.format(row[2])
-        html = html + '{}</td><td>'.format(row[3])
-        html = html + '{}</td><td>'.format(row[4])
-        html = html + '{}</td><td>'.format(row[5])
-        html = html + '{}</td><td>'.format(row[6])
-        html = html + '{}</td></tr>'.format(row[7])
-        num = num + 1
-    cursor.close()
-    conn.close()
-    html = html + '<table><html>'
-    return html
-
-def add_sql_param(sql, param_name, param_value, s_and):
-    """Add filter by param value to sql"""
-    if param_value != '':
-        if param_name == 'date':
-            if str(param_value[0]) + str(param_value[1]) != '':
-                if param_value[0] == '':
-                    sql = '{}{} {} <= "{}"'.format(sql, s_and, param_name, param_value[1])
-                else:
-                    if param_value[1] == '':
-                        sql = '{}{} {} >= "{}"'.format(sql, s_and, param_name, param_value[0])
-                    else:
-                        sql = '{}{} {} BETWEEN "{}" AND "{}"'.format(sql, s_and, param_name, param_value[0], param_value[1])
-        else:
-            if (param_name == 'result') and (param_value != R_OK):
-                sql = '{}{} {} & {} <> 0'.format(sql, s_and, param_name, param_value)
-            else:
-                sql = '{}{} {} = "{}"'.format(sql, s_and, param_name, param_value)
-        if s_and == '':
-            s_and = ' AND'
-    return sql, s_and
+        escape(flt['date1']), escape(flt['date2']), flt['result_ok'], flt['multiple_use'], flt['time_exceed'],
+        flt['online_failed'], flt['invalid_type'], flt['invalid_fn'], escape(flt['ch_sum']), escape(flt['ch_fn']),
+        escape(flt['ch_fd']), escape(flt['ch_fp']), escape(flt['ch_t']))
+
+    def generate():
+        """Render rows in chunks while they are read from base"""
+        yield html
+        with g_state['db_ro'].connection() as conn:
+            for chunk in base_rows(conn.cursor(), where, params, before, before_id, num, flt):
+                yield chunk
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+def base_rows(cursor, where, params, before, before_id, num, flt):
+    """Yield base page rows and footer as html chunks"""
+    try:
+        with metrics.timer('szpark_base_query_seconds', query='count'):
+            cursor.execute('SELECT COUNT(*) FROM checks' + where, params)
+            total = cursor.fetchone()[0]
+        page_where, page_params = where, list(params)
+        if before:
+            page_where = page_where + (' AND' if page_where else ' WHERE') + ' (date < ? OR (date = ? AND id < ?))'
+            page_params = page_params + [before, before, before_id]
+        sql = 'SELECT strftime("%d.%m.%Y %H:%M:%S", date, "unixepoch", "localtime"), result,\
+            strftime("%d.%m.%Y %H:%M:%S", ch_date, "unixepoch", "localtime"), printf("%d.%02d", ch_sum / 100, ch_sum % 100),\
+            ch_fn, ch_fd, ch_fp, ch_t, date, id FROM checks{} ORDER BY date DESC, id DESC LIMIT ?'.format(page_where)
+        with metrics.timer('szpark_base_query_seconds', query='page'):
+            cursor.execute(sql, page_params + [BASE_PAGE_SIZE])
+        row_num = num
+        last = None
+        while True:
+            rows = cursor.fetchmany(BASE_CHUNK_SIZE)
+            if not rows:
+                break
+            chunk = []
+            for row in rows:
+                chunk.append('<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>'.format(
+                    row_num, row[0], result_decode(row[1], True), row[2], row[3], row[4], row[5], row[6], row[7]))
+                row_num = row_num + 1
+                last = row
+            yield ''.join(chunk)
+        footer = '</table><p>shown {} - {} of {}'.format(num, row_num - 1, total)
+        if last is not None and row_num - 1 < total:
+            args = dict((k, v) for k, v in flt.items() if v != '')
+            args.update({'before': last[8], 'before_id': last[9], 'num': row_num})
+            footer = footer + ' <a href="/base?{}">next page</a>'.format(escape(urlencode(args)))
+        yield footer + '</p></html>'
+    finally:
+        cursor.close()
+
+def base_filter(flt):
+    """Build WHERE clause with bound parameters for base page filters"""
+    where = []
+    params = []
+    if flt['result_ok'] == 'checked':
+        add_sql_param(where, params, 'result', R_OK)
+    if flt['multiple_use'] == 'checked':
+        add_sql_param(where, params, 'result', R_FAIL_MULTI)
+    if flt['time_exceed'] == 'checked':
+        add_sql_param(where, params, 'result', R_FAIL_TIME)
+    if flt['online_failed'] == 'checked':
+        add_sql_param(where, params, 'result', R_FAIL_ONLINE)
+    if flt['invalid_type'] == 'checked':
+        add_sql_param(where, params, 'result', R_FAIL_TYPE)
+    if flt['invalid_fn'] == 'checked':
+        add_sql_param(where, params, 'result', R_FAIL_FN)
+    # a value that is not a number matches nothing
+    if flt['ch_sum'] != '':
+        value = parse_kop(flt['ch_sum'])
+        add_sql_param(where, params, 'ch_sum', -1 if value is None else value)
+    for name in ('ch_fn', 'ch_fd', 'ch_fp', 'ch_t'):
+        if flt[name] != '':
+            value = to_int(flt[name])
+            add_sql_param(where, params, name, -1 if value is None else value)
+    try:
+        add_sql_param(where, params, 'date1', to_epoch(datetime.strptime(flt['date1'], '%Y-%m-%d')))
+    except ValueError:
+        pass
+    try:
+        add_sql_param(where, params, 'date2', to_epoch(datetime.strptime(flt['date2'], '%Y-%m-%d') + timedelta(days=1)))
+    except ValueError:
+        pass
+    if not where:
+        return '', params
+    return ' WHERE ' + ' AND '.join(where), params
+
+def add_sql_param(where, params, param_name, param_value):
+    """Add filter by param value to where clause list"""
+    if param_name == 'date1':
+        where.append('date >= ?')
+    elif param_name == 'date2':
+        where.append('date < ?')
+    elif (param_name == 'result') and (param_value != R_OK):
+        where.append('result & ? <> 0')
+    else:
+        where.append('{} = ?'.format(param_name))
+    params.append(param_value)
 
 @app.route('/log')
 @auth.login_required
 def www_log():
-    """Function for Web Interface (log page)"""
-    html = '<html><pre>'
-    f_log = open(__file__.replace('.py', '.log'), mode='r')
-    lines = f_log.readlines()
-    lines.reverse()
-    for line in lines:
-        html = html + line
-    f_log.close()
-    html = html + '</pre></html>'
-    return html
+    """Function for Web Interface (log page)
+
+    Shows newest lines first. Query: lines=N (default LOG_LINES), since=YYYY-MM-DD HH:MM,
+    level=NAME (min level), live=1 (append new lines as they are written).
+    """
+    max_lines = request.args.get('lines', LOG_LINES, type=int)
+    since = request.args.get('since', '').replace('T', ' ')[:16]
+    level = logging.getLevelName(request.args.get('level', 'NOTSET').upper())
+    if not isinstance(level, int):
+        level = logging.NOTSET
+    live = request.args.get('live', '')
+
+    def generate():
+        """Render log lines while they are read from the end of files"""
+        yield '<html><pre id="log">'
+        if live:
+            yield '<span id="live"></span>'
+        n = 0
+        for line in log_lines_reversed():
+            line_time = line[:16]
+            if since and LOG_LINE_TIME.match(line) and line_time < since:
+                break
+            if level and log_line_level(line) < level:
+                continue
+            yield escape(line) + '\n'
+            n = n + 1
+            if n >= max_lines:
+                break
+        yield '</pre>'
+        if live:
+            yield LOG_LIVE_JS
+        yield '</html>'
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+@app.route('/log/tail')
+@auth.login_required
+def www_log_tail():
+    """Function for Web Interface (new log lines as server-sent events)"""
+    return live_response(log_tail())
+
+def log_files():
+    """Log file and its rotated backups, newest first"""
+    fn = __file__.replace('.py', '.log')
+    files = [fn] + ['{}.{}'.format(fn, i) for i in range(1, g_cfg['log_num'] + 1)]
+    return [f for f in files if os.path.exists(f)]
+
+def log_read(fn, pos, size):
+    """Read block of log file without keeping it open
+
+    On Windows an open handle makes rotation of the log fail, so a slow
+    web client must not hold one between reads.
+    """
+    with open(fn, mode='rb') as f_log:
+        f_log.seek(pos)
+        return f_log.read(size)
+
+def log_lines_reversed():
+    """Yield log lines newest first, reading files backwards in blocks"""
+    for fn in log_files():
+        try:
+            pos = os.path.getsize(fn)
+        except OSError:
+            continue
+        tail = b''
+        while pos > 0:
+            size = min(LOG_BLOCK_SIZE, pos)
+            pos = pos - size
+            try:
+                block = log_read(fn, pos, size)
+            except OSError:
+                break
+            lines = (block + tail).split(b'\n')
+            # first piece may be a part of line from the previous block
+            tail = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip():
+                    yield line.rstrip(b'\r').decode('utf-8', errors='replace')
+        if tail.strip():
+            yield tail.rstrip(b'\r').decode('utf-8', errors='replace')
+
+def log_line_level(line):
+    """Level of log line, lines without level (tracebacks) are always shown"""
+    if not LOG_LINE_TIME.match(line):
+        return logging.CRITICAL
+    level = logging.getLevelName(line[24:31].strip())
+    return level if isinstance(level, int) else logging.CRITICAL
+
+def log_tail():
+    """Yield lines appended to the log as server-sent events
+
+    The file is opened for each read only, new data is found by its offset.
+    """
+    fn = __file__.replace('.py', '.log')
+    try:
+        offset = os.path.getsize(fn)
+    except OSError:
+        offset = 0
+    partial = b''
+    while True:
+        try:
+            # file was rotated: continue from the start of the new one
+            if os.path.getsize(fn) < offset:
+                offset = 0
+                partial = b''
+            data = log_read(fn, offset, LOG_BLOCK_SIZE)
+        except OSError:
+            data = b''
+        offset = offset + len(data)
+        lines = (partial + data).split(b'\n')
+        partial = lines.pop()
+        for line in lines:
+            yield 'data: {}\n\n'.format(line.rstrip(b'\r').decode('utf-8', errors='replace'))
+        if len(data) < LOG_BLOCK_SIZE:
+            time.sleep(LOG_TAIL_INTERVAL)
+            # comment line keeps the connection alive and detects closed clients
+            yield ':\n\n'
 
 @app.route('/opensesame')
 @auth.login_required
 def www_open():
-    """Function for Web Interface (open parking)"""
-    logging.info("WWW: opening parking")
-    th_open = threading.Thread(target=open_parking, args=())
-    th_open.start()
+    """Function for Web Interface (open parking, first lane if lane is not given)"""
+    lanes = g_state['lanes']
+    name = request.args.get('lane')
+    if name is None:
+        lane = next(iter(lanes.values()))
+    elif name in lanes:
+        lane = lanes[name]
+    else:
+        return Response('unknown lane\n', status=404, mimetype='text/plain')
+    logging.info("WWW: opening parking (lane %s)", lane.name)
+    open_parking(lane)
+    return redirect('/')
+
+def thread_samples():
+    """Thread liveness, heartbeat and restart samples for /metrics"""
+    now = time.monotonic()
+    samples = []
+    for worker in list(supervisor.workers.values()):
+        name, _, n = worker.name.partition(':')
+        labels = {'thread': name}
+        if n:
+            labels['lane' if name == 'scan' else 'n'] = n
+        samples.append(('szpark_thread_alive', labels, 1 if worker.alive() else 0))
+        samples.append(('szpark_thread_heartbeat_age_seconds', labels, round(now - worker.beat_time, 3)))
+        samples.append(('szpark_thread_restarts_total', labels, worker.restarts))
+    if 'th_watch' in g_state:
+        samples.append(('szpark_thread_alive', {'thread': 'watch'}, 1 if g_state['th_watch'].is_alive() else 0))
+    return samples
+
+@app.route('/metrics')
+@auth.login_required
+def www_metrics():
+    """Function for Web Interface (metrics in Prometheus text format)"""
+    samples = thread_samples()
+    startup = list(g_state['startup'].items())
+    if 'first_scan' in g_state:
+        startup.append(('first_accepted_scan', g_state['first_scan']))
+    samples.extend(('szpark_startup_seconds', {'phase': phase}, round(t_end, 4)) for phase, t_end in startup)
+    queues = [g_state['q_scan'], g_state['q_write']]
+    if 'q_online' in g_state:
+        queues.append(g_state['q_online'])
+    for q in queues:
+        samples.append(('szpark_queue_size', {'queue': q.name}, q.qsize()))
+        samples.append(('szpark_queue_dropped_total', {'queue': q.name}, q.drops))
+    if g_cfg['pc_enable']:
+        samples.append(('szpark_parking_counter', {}, g_state['pc']))
+    return Response(metrics.text(samples), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profile')
+@auth.login_required
+def www_profile():
+    """Function for Web Interface (sampling profiler: ?start=1, ?stop=1, ?reset=1)"""
+    sampler = g_state['sampler']
+    if request.args.get('reset'):
+        sampler.reset()
+    if request.args.get('start'):
+        # type=float gives None for text that is not a number
+        interval = request.args.get('interval', type=float) if 'interval' in request.args else g_cfg['profile_interval']
+        # (also rejects nan and inf, sampler sleeps the interval)
+        if interval is None or not 0 < interval < float('inf'):
+            return Response('interval must be a positive number of seconds\n', status=400, mimetype='text/plain')
+        sampler.start(interval)
+    if request.args.get('stop'):
+        sampler.stop()
+    return Response(sampler.text(), mimetype='text/plain')
+
+def report_range():
+    """Aggregate period and [start, end) range from request args period=day|hour, from, to (dates)"""
+    period = 'h' if request.args.get('period') == 'hour' else 'd'
+    date1 = datetime.strptime(request.args.get('from') or datetime.now().strftime('%Y-%m-%d'), '%Y-%m-%d')
+    date2 = datetime.strptime(request.args['to'], '%Y-%m-%d') if request.args.get('to') else date1
+    return period, date1.strftime('%Y-%m-%d'), (date2 + timedelta(days=1)).strftime('%Y-%m-%d')
+
+def report_response(rows, fields):
+    """Report rows as JSON or CSV (format=csv)"""
+    if request.args.get('format') == 'csv':
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+        return Response(out.getvalue(), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=szpark_report.csv'})
+    return Response(json.dumps(rows, ensure_ascii=False), mimetype='application/json')
+
+@app.route('/report')
+@auth.login_required
+def www_report():
+    """Function for Web Interface (scan counts by period, fn and fail reason)
+
+    Args: period=day|hour, from and to dates (YYYY-MM-DD, default today),
+    group=fn|total, format=json|csv.
+    """
+    try:
+        period, start, end = report_range()
+    except ValueError:
+        return Response('dates must be YYYY-MM-DD\n', status=400, mimetype='text/plain')
+    by_fn = request.args.get('group', 'fn') != 'total'
+    fields = ['start'] + (['fn', 'fn_label'] if by_fn else []) + ['total', 'ok'] + [name for name, _ in REPORT_REASONS]
+    rows = OrderedDict()
+    with g_state['db_ro'].connection() as conn:
+        for row_start, ch_fn, result, count in conn.execute(
+                'SELECT start, ch_fn, result, count FROM stats WHERE period = ? AND start >= ? AND start < ? ORDER BY start, ch_fn',
+                (period, start, end)):
+            key = (row_start, ch_fn if by_fn else None)
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = OrderedDict((field, 0) for field in fields)
+                row['start'] = row_start
+                if by_fn:
+                    row['fn'] = ch_fn
+                    row['fn_label'] = g_cfg['fns'].get(ch_fn, '')
+            row['total'] += count
+            if result == R_OK:
+                row['ok'] += count
+            for name, bit in REPORT_REASONS:
+                if result & bit:
+                    row[name] += count
+    return report_response(list(rows.values()), fields)
+
+@app.route('/report/occupancy')
+@auth.login_required
+def www_report_occupancy():
+    """Function for Web Interface (parking counter peaks by period, args as for /report)"""
+    try:
+        period, start, end = report_range()
+    except ValueError:
+        return Response('dates must be YYYY-MM-DD\n', status=400, mimetype='text/plain')
+    fields = ['start', 'peak', 'low']
+    with g_state['db_ro'].connection() as conn:
+        rows = [OrderedDict(zip(fields, row)) for row in conn.execute(
+            'SELECT start, peak, low FROM occupancy WHERE period = ? AND start >= ? AND start < ? ORDER BY start',
+            (period, start, end))]
+    return report_response(rows, fields)
+
+@app.route('/export')
+@auth.login_required
+def www_export():
+    """Function for Web Interface (checks history download, streamed in chunks)
+
+    Args: format=csv|ndjson|columns, from and to dates (YYYY-MM-DD, default all history).
+    """
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return Response('format must be one of {}\n'.format(', '.join(EXPORT_FORMATS)), status=400, mimetype='text/plain')
+    try:
+        date1, date2 = export_range(request.args.get('from'), request.args.get('to'))
+    except ValueError:
+        return Response('dates must be YYYY-MM-DD\n', status=400, mimetype='text/plain')
+    mimetype, ext, writer, _ = EXPORT_FORMATS[fmt]
+    logging.info('WWW: exporting checks (%s)', fmt)
+    return Response(writer(export_chunks(g_state['db_ro'].connection, date1, date2)), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=szpark_checks' + ext})
+
+@app.route('/reload')
+@auth.login_required
+def www_reload():
+    """Function for Web Interface (reload config)"""
+    logging.info("WWW: reloading config")
+    reload_cfg()
     return redirect('/')
 
 def result_decode(result, html=False):
@@ -286,273 +2052,713 @@ def result_decode(result, html=False):
             result_s = result_s + ' | invalid fn'
     return result_s
 
-def open_com():
-    """Open serial port, retrying on failure"""
+def open_com(lane):
+    """Open lane serial port, retrying on failure"""
     nf = 0
     while True:
         try:
-            g_cfg['serial'] = serial.Serial(
-                g_cfg['com'],
-                timeout=None,
-                baudrate=g_cfg['speed'],
+            lane.serial = serial.serial_for_url(
+                lane.cfg.com,
+                timeout=lane.cfg.scan_gap,
+                baudrate=lane.cfg.speed,
                 xonxoff=False,
                 rtscts=False,
                 dsrdtr=False)
-            g_cfg['serial'].isOpen()
-            logging.info('Open ' + g_cfg['com'])
+            lane.serial.isOpen()
+            logging.info('Open %s (lane %s)', lane.cfg.com, lane.name)
             break
         except serial.SerialException:
+            lane.serial = None
             time.sleep(g_cfg['scan_interval'])
             nf = nf + 1
             if nf == 1:
-                logging.info('Failed to open ' + g_cfg['com'])
+                logging.info('Failed to open %s (lane %s)', lane.cfg.com, lane.name)
             break
 
-def read_cfg():
-    """Read config"""
+def read_lanes(config):
+    """Read lane settings from [lane.<name>] sections
+
+    Keys missing in a lane section are taken from [szpark]. Without lane
+    sections [szpark] itself describes the only lane named 'main'.
+    """
+    sections = [section for section in config.sections() if section.startswith(LANE_SECTION)]
+    lanes = OrderedDict()
+    for section in sections or ['szpark']:
+        def get(key, fallback=None, section=section):
+            value = config.get(section, key, fallback=config.get('szpark', key, fallback=fallback))
+            if value is None:
+                raise configparser.NoOptionError(key, section)
+            return value
+        name = section[len(LANE_SECTION):] if sections else 'main'
+        lanes[name] = LaneCfg(
+            name,
+            get('com'),
+            get('speed'),
+            int(get('mbccoil')),
+            float(get('mbctime')),
+            float(get('scan_gap', '0.05')),
+            codecs.decode(get('scan_terminator', '\\r'), 'unicode_escape').encode('latin-1'))
+    return MappingProxyType(lanes)
+
+def read_cfg(fn):
+    """Read config file into a new read-only config snapshot"""
     config = configparser.ConfigParser()
-    config.read(g_cfg['fn'], encoding='utf-8-sig')
+    config.read(fn, encoding='utf-8-sig')
+    cfg = {'fn': fn}
+    cfg['log_level'] = config.getint('szpark', 'log_level')
+    cfg['log_size'] = config.getint('szpark', 'log_size')
+    cfg['log_num'] = config.getint('szpark', 'log_num')
+    cfg['online'] = config.getboolean('szpark', 'online')
+    cfg['mbcip'] = config.get('szpark', 'mbcip')
+    cfg['mbcport'] = config.getint('szpark', 'mbcport')
+    cfg['onlinefound'] = config.get('szpark', 'onlinefound')
+    cfg['online_url'] = config.get('szpark', 'online_url', fallback='http://receipt.taxcom.ru/v01/show')
+    cfg['online_timeout'] = config.getfloat('szpark', 'online_timeout', fallback=3)
+    cfg['online_failopen'] = config.getboolean('szpark', 'online_failopen', fallback=True)
+    cfg['online_pool'] = config.getint('szpark', 'online_pool', fallback=4)
+    cfg['online_cache_size'] = config.getint('szpark', 'online_cache_size', fallback=1024)
+    cfg['online_cache_ttl'] = config.getint('szpark', 'online_cache_ttl', fallback=3600)
+    cfg['multiple'] = config.getboolean('szpark', 'multiple')
+    cfg['interval'] = timedelta(seconds=config.getint('szpark', 'interval'))
+    cfg['scan_interval'] = config.getint('szpark', 'scan_interval')
+    cfg['lanes'] = read_lanes(config)
+    cfg['scan_queue'] = config.getint('szpark', 'scan_queue', fallback=32)
+    cfg['scan_workers'] = config.getint('szpark', 'scan_workers', fallback=2)
+    cfg['write_queue'] = config.getint('szpark', 'write_queue', fallback=256)
+    cfg['db_commit_interval'] = config.getfloat('szpark', 'db_commit_interval', fallback=0.2)
+    cfg['archive_days'] = config.getint('szpark', 'archive_days', fallback=0)
+    cfg['pc_capacity'] = config.getint('szpark', 'pc_capacity')
+    cfg['fns'] = read_fns(config, fn)
+    cfg['validator'] = CheckValidator(cfg['fns'], cfg['interval'])
+    # parking counter options
+    cfg['pc_enable'] = config.getboolean('szpark', 'pc_enable')
+    cfg['mbcreg_init_in'] = config.getint('szpark', 'mbcreg_init_in')
+    cfg['mbcreg_init_out'] = config.getint('szpark', 'mbcreg_init_out')
+    cfg['mbccoil_save'] = config.getint('szpark', 'mbccoil_save')
+    cfg['mbccoil_reset_in'] = config.getint('szpark', 'mbccoil_reset_in')
+    cfg['mbccoil_reset_out'] = config.getint('szpark', 'mbccoil_reset_out')
+    cfg['mbcreg_in'] = config.getint('szpark', 'mbcreg_in')
+    cfg['mbcreg_out'] = config.getint('szpark', 'mbcreg_out')
+    cfg['pc_init'] = config.getint('szpark', 'pc_init')
+    cfg['pc_interval'] = config.getfloat('szpark', 'pc_interval')
+    cfg['pc_interval_fast'] = config.getfloat('szpark', 'pc_interval_fast', fallback=0.2)
+    cfg['pc_fast_time'] = config.getfloat('szpark', 'pc_fast_time', fallback=10)
+    cfg['pc_save_delay'] = config.getfloat('szpark', 'pc_save_delay', fallback=5)
+    # web interface options
+    cfg['www_addr'] = config.get('szpark', 'www_addr')
+    cfg['www_port'] = config.getint('szpark', 'www_port')
+    cfg['www_login'] = config.get('szpark', 'www_login')
+    cfg['www_pass'] = config.get('szpark', 'www_pass')
+    cfg['www_server'] = config.get('szpark', 'www_server', fallback='flask')
+    cfg['www_threads'] = config.getint('szpark', 'www_threads', fallback=4)
+    cfg['live_clients'] = config.getint('szpark', 'live_clients', fallback=8)
+    # watchdog options
+    cfg['watchdog'] = config.getboolean('szpark', 'watchdog')
+    cfg['watch_interval'] = config.getint('szpark', 'watch_interval')
+    cfg['watch_stall'] = config.getfloat('szpark', 'watch_stall', fallback=10)
+    cfg['reload_interval'] = config.getfloat('szpark', 'reload_interval', fallback=5)
+    # profiler options
+    cfg['profile'] = config.getboolean('szpark', 'profile', fallback=False)
+    cfg['profile_interval'] = config.getfloat('szpark', 'profile_interval', fallback=0.01)
+    return MappingProxyType(cfg)
+
+def setup_logging(cfg):
+    """Set log level and (re)create log file handler when its options change"""
     logger = logging.getLogger()
-    logger.setLevel(config.getint('szpark', 'log_level'))
+    logger.setLevel(cfg['log_level'])
+    handler = g_state.get('log_handler')
+    if handler is not None:
+        if (handler.maxBytes, handler.backupCount) == (cfg['log_size'], cfg['log_num']):
+            return
+        logger.removeHandler(handler)
+        handler.close()
     handler = RotatingFileHandler(
         __file__.replace('.py', '.log'),
-        maxBytes=config.getint('szpark', 'log_size'),
-        backupCount=config.getint('szpark', 'log_num'))
+        maxBytes=cfg['log_size'],
+        backupCount=cfg['log_num'],
+        encoding='utf-8')
     formatter = logging.Formatter('%(asctime)-15s %(levelname)-7.7s %(message)s')
     handler.setFormatter(formatter)
     logger.addHandler(handler)
-    g_cfg['com'] = config.get('szpark', 'com')
-    g_cfg['speed'] = config.get('szpark', 'speed')
-    g_cfg['online'] = config.getboolean('szpark', 'online')
-    g_cfg['mbcip'] = config.get('szpark', 'mbcip')
-    g_cfg['mbcport'] = config.getint('szpark', 'mbcport')
-    g_cfg['mbccoil'] = config.getint('szpark', 'mbccoil')
-    g_cfg['mbctime'] = config.getfloat('szpark', 'mbctime')
-    g_cfg['onlinefound'] = config.get('szpark', 'onlinefound')
-    g_cfg['multiple'] = config.getboolean('szpark', 'multiple')
-    g_cfg['interval'] = timedelta(seconds=config.getint('szpark', 'interval'))
-    g_cfg['scan_interval'] = config.getint('szpark', 'scan_interval')
-    g_cfg['pc_capacity'] = config.getint('szpark', 'pc_capacity')
-    g_cfg['fns'] = []
-    nfn = 1
+    g_state['log_handler'] = handler
+
+def dup_index_load():
+    """Load multiple use index from base (startup thread function)"""
+    with g_state['db_ro'].connection() as conn:
+        g_state['dup_index'].load(conn.cursor())
+
+def apply_cfg():
+    """Bring runtime objects in line with the current config snapshot"""
+    if not g_cfg['multiple']:
+        if 'dup_index' not in g_state:
+            g_state['dup_index'] = DupIndex(g_cfg['interval'])
+            # validation waits for the index, everything else goes on meanwhile
+            threading.Thread(target=dup_index_load, args=(), daemon=True).start()
+        else:
+            g_state['dup_index'].interval = g_cfg['interval'].total_seconds()
+    if g_cfg['online'] and 'online_session' not in g_state:
+        online_init()
+    if g_cfg['profile']:
+        g_state['sampler'].start(g_cfg['profile_interval'])
+    else:
+        g_state['sampler'].stop()
+    if 'lanes' in g_state:
+        for name, lane_cfg in g_cfg['lanes'].items():
+            if name in g_state['lanes']:
+                g_state['lanes'][name].cfg = lane_cfg
+            else:
+                lane_start(lane_cfg)
+
+def keep_restart_keys(cfg, running):
+    """New snapshot with restart-only values (and removed lanes) taken from the running one"""
+    cfg = dict(cfg)
+    for k in CFG_RESTART_KEYS:
+        cfg[k] = running[k]
+    lanes = OrderedDict()
+    for name, lane in running['lanes'].items():
+        new = cfg['lanes'].get(name)
+        lanes[name] = lane if new is None else new._replace(**dict((k, getattr(lane, k)) for k in LANE_RESTART_KEYS))
+    for name, lane in cfg['lanes'].items():
+        lanes.setdefault(name, lane)
+    cfg['lanes'] = lanes
+    return MappingProxyType(cfg)
+
+def reload_cfg():
+    """Re-read config file and swap in the new snapshot
+
+    Keys in CFG_RESTART_KEYS are only applied on service restart, until then
+    the new snapshot keeps their running values.
+    """
+    global g_cfg, users # pylint: disable=global-statement
+    with cfg_lock:
+        try:
+            cfg = read_cfg(g_cfg['fn'])
+        except (configparser.Error, ValueError) as e:
+            g_state['cfg_error'] = str(e)
+            logging.error('Config reload failed, keeping current config: %s', e)
+            return False
+        changed = sorted(k for k in CFG_RESTART_KEYS if cfg[k] != g_cfg[k])
+        for name, lane in g_cfg['lanes'].items():
+            if name not in cfg['lanes']:
+                changed.append('lane {} removed'.format(name))
+                continue
+            changed.extend('{}.{}'.format(name, k) for k in LANE_RESTART_KEYS
+                           if getattr(lane, k) != getattr(cfg['lanes'][name], k))
+        if changed:
+            logging.warning('Config changes applied on restart only: %s', ', '.join(changed))
+            cfg = keep_restart_keys(cfg, g_cfg)
+        setup_logging(cfg)
+        users = {cfg['www_login']: cfg['www_pass']}
+        g_cfg = cfg
+        apply_cfg()
+        g_state['cfg_error'] = ''
+        g_state['cfg_time'] = time.time()
+        g_state['cfg_reloads'] += 1
+        logging.info('Config reloaded')
+        return True
+
+def cfg_th_fn():
+    """Thread function reloading config when the ini file changes"""
+    mtime = os.stat(g_cfg['fn']).st_mtime
     while True:
+        time.sleep(g_cfg['reload_interval'] or CFG_IDLE_INTERVAL)
+        if not g_cfg['reload_interval']:
+            continue
         try:
-            g_cfg['fns'].append(config.get('szpark', 'fn{}'.format(nfn)))
-            nfn = nfn + 1
-        except configparser.NoOptionError:
-            break
-    # parking counter options
-    g_cfg['pc_enable'] = config.getboolean('szpark', 'pc_enable')
-    g_cfg['mbcreg_init_in'] = config.getint('szpark', 'mbcreg_init_in')
-    g_cfg['mbcreg_init_out'] = config.getint('szpark', 'mbcreg_init_out')
-    g_cfg['mbccoil_save'] = config.getint('szpark', 'mbccoil_save')
-    g_cfg['mbccoil_reset_in'] = config.getint('szpark', 'mbccoil_reset_in')
-    g_cfg['mbccoil_reset_out'] = config.getint('szpark', 'mbccoil_reset_out')
-    g_cfg['mbcreg_in'] = config.getint('szpark', 'mbcreg_in')
-    g_cfg['mbcreg_out'] = config.getint('szpark', 'mbcreg_out')
-    g_cfg['pc_init'] = config.getint('szpark', 'pc_init')
-    g_cfg['pc_interval'] = config.getint('szpark', 'pc_interval')
-    # web interface options
-    g_cfg['www_addr'] = config.get('szpark', 'www_addr')
-    g_cfg['www_port'] = config.getint('szpark', 'www_port')
-    g_cfg['www_login'] = config.get('szpark', 'www_login')
-    g_cfg['www_pass'] = config.get('szpark', 'www_pass')
-    users[g_cfg['www_login']] = g_cfg['www_pass']
-    # watchdog options
-    g_cfg['watchdog'] = config.getboolean('szpark', 'watchdog')
-    g_cfg['watch_interval'] = config.getint('szpark', 'watch_interval')
+            new_mtime = os.stat(g_cfg['fn']).st_mtime
+        except OSError:
+            continue
+        if new_mtime != mtime:
+            mtime = new_mtime
+            reload_cfg()
 
 def pc_reset():
     """Reset parking counters"""
-    mbc = ModbusClient(g_cfg['mbcip'], port=g_cfg['mbcport'])
-    with pc_lock:
-        if mbc.connect():
-            mbc.write_register(g_cfg['mbcreg_init_in'], g_cfg['pc'], unit=1)
-            mbc.write_register(g_cfg['mbcreg_init_in'] + 1, 0, unit=1)
-            mbc.write_register(g_cfg['mbcreg_init_out'], 0, unit=1)
-            mbc.write_register(g_cfg['mbcreg_init_out'] + 1, 0, unit=1)
-            mbc.write_coil(g_cfg['mbccoil_save'], 1, unit=1)
-            mbc.write_coil(g_cfg['mbccoil_reset_in'], 1, unit=1)
-            mbc.write_coil(g_cfg['mbccoil_reset_in'] + 1, 1, unit=1)
-            mbc.write_coil(g_cfg['mbccoil_reset_out'], 1, unit=1)
-            mbc.write_coil(g_cfg['mbccoil_reset_out'] + 1, 1, unit=1)
-            mbc.close()
+    def command(mbc):
+        mbc.write_register(g_cfg['mbcreg_init_in'], g_state['pc'], unit=1)
+        mbc.write_register(g_cfg['mbcreg_init_in'] + 1, 0, unit=1)
+        mbc.write_register(g_cfg['mbcreg_init_out'], 0, unit=1)
+        mbc.write_register(g_cfg['mbcreg_init_out'] + 1, 0, unit=1)
+        mbc.write_coil(g_cfg['mbccoil_save'], 1, unit=1)
+        mbc.write_coil(g_cfg['mbccoil_reset_in'], 1, unit=1)
+        mbc.write_coil(g_cfg['mbccoil_reset_in'] + 1, 1, unit=1)
+        mbc.write_coil(g_cfg['mbccoil_reset_out'], 1, unit=1)
+        return mbc.write_coil(g_cfg['mbccoil_reset_out'] + 1, 1, unit=1)
+    try:
+        g_state['mb'].call(command, key='pc_reset')
+    except ModbusError as e:
+        logging.info('Failed to reset parking counters: %s', e)
+
+def pc_sync():
+    """Reset parking counters at start unless the controller already has the stored value
+
+    One counter read instead of the nine writes of a reset on every restart.
+    """
+    try:
+        cnt_in, cnt_out = g_state['mb'].call(read_pc, key='read_pc')
+    except ModbusError as e:
+        logging.info('Failed to read parking counters: %s', e)
+    else:
+        if cnt_in - cnt_out == g_state['pc']:
+            logging.info('Parking counters in sync: %d', g_state['pc'])
+            return
+    pc_reset()
+
+def update_occupancy():
+    """Queue occupancy peak/low update with the current counter value"""
+    params = (int(time.time()), g_state['pc'])
+    for sql in SQL_OCCUPANCY_UPDATE:
+        g_state['q_write'].offer((sql, params))
 
 def update_pc():
     """Update parking counter value in db"""
-    dbfn = __file__.replace('.py', '.sqlite')
-    conn = sqlite3.connect(dbfn)
-    cursor = conn.cursor()
-    cursor.execute('SELECT value FROM pc')
-    result = cursor.fetchone()
-    if result:
-        pc_o = result[0]
-        cursor.execute('UPDATE pc SET value=? WHERE value=?', (g_cfg['pc'], pc_o))
-    else:
-        cursor.execute('INSERT INTO pc(value) VALUES (?)', (g_cfg['pc'],))
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-def open_parking():
-    """Open parking"""
-    mbc = ModbusClient(g_cfg['mbcip'], port=g_cfg['mbcport'])
-    with pc_lock:
-        if mbc.connect():
-            mbc.write_coil(g_cfg['mbccoil'], True, unit=1)
-            time.sleep(g_cfg['mbctime'])
-            mbc.write_coil(g_cfg['mbccoil'], False, unit=1)
-            mbc.close()
+    g_state['q_write'].offer((SQL_PC, (g_state['pc'],)))
+    g_state['pc_writes'].tick()
+
+def open_parking(lane):
+    """Open lane barrier (returns at once, coil is switched off by scheduler)"""
+    g_state['pulse'].pulse(lane.cfg.mbccoil, lane.cfg.mbctime)
+
+def lane_start(lane_cfg):
+    """Create lane and start its reader thread"""
+    lane = Lane(lane_cfg)
+    g_state['lanes'][lane.name] = lane
+    supervisor.add('scan:' + lane.name, scan_th_fn, (lane,),
+                   stall=lambda: max(g_cfg['watch_stall'], g_cfg['scan_interval'] + SUP_BEAT_INTERVAL),
+                   cleanup=lane.close)
 
 def watch_th_fn():
-    """Watchdog thread function"""
+    """Watchdog thread function, sends thread health to live status clients on change
+
+    Dead threads and threads without a heartbeat for watch_stall seconds are
+    restarted, repeated failures wait up to watch_interval seconds.
+    """
+    health = None
     while True:
-        if not g_cfg['th_scan'].is_alive():
-            logging.info('Scan thread restarted')
-            g_cfg['th_scan'] = threading.Thread(target=scan_th_fn, args=())
-            g_cfg['th_scan'].start()
-        if g_cfg['pc_enable']:
-            if not g_cfg['th_pc'].is_alive():
-                logging.info('Parking counter thread restarted')
-                g_cfg['th_pc'] = threading.Thread(target=pc_th_fn, args=())
-                g_cfg['th_pc'].start()
-        time.sleep(g_cfg['watch_interval'])
+        supervisor.check(g_cfg['watch_interval'])
+        current = thread_health()
+        if current != health:
+            health = current
+            g_state['live'].publish('health', health)
+        time.sleep(SUP_CHECK_INTERVAL)
+
+def read_pc(mbc):
+    """Modbus command reading input and output counters in one request"""
+    reg_first = min(g_cfg['mbcreg_in'], g_cfg['mbcreg_out'])
+    reg_count = abs(g_cfg['mbcreg_in'] - g_cfg['mbcreg_out']) + 1
+    result = mbc.read_input_registers(reg_first, reg_count, unit=1)
+    if result.isError():
+        return result
+    return (result.getRegister(g_cfg['mbcreg_in'] - reg_first),
+            result.getRegister(g_cfg['mbcreg_out'] - reg_first))
 
 def pc_th_fn():
-    """Thread function for parking counter"""
-    pc_reset()
-    mbc = ModbusClient(g_cfg['mbcip'], port=g_cfg['mbcport'])
+    """Thread function for parking counter
+
+    Polls fast for pc_fast_time after a change and at pc_interval when idle.
+    The counter is stored at most once per pc_save_delay.
+    """
+    pc_sync()
+    t_change = 0
+    t_save = 0
+    dirty = False
     while True:
-        with pc_lock:
-            if mbc.connect():
-                result = mbc.read_input_registers(g_cfg['mbcreg_in'], 1, unit=1)
-                cnt_in = result.getRegister(0)
-                result = mbc.read_input_registers(g_cfg['mbcreg_out'], 1, unit=1)
-                cnt_out = result.getRegister(0)
-                mbc.close()
-                if g_cfg['pc'] != cnt_in - cnt_out:
+        supervisor.heartbeat()
+        try:
+            with metrics.timer('szpark_pc_poll_seconds'):
+                cnt_in, cnt_out = g_state['mb'].call(read_pc, key='read_pc')
+            g_state['pc_reads'].tick()
+        except ModbusError as e:
+            logging.debug('Failed to read parking counters: %s', e)
+        else:
+            with pc_lock:
+                if g_state['pc'] != cnt_in - cnt_out:
                     if (cnt_in - cnt_out) < 0:
-                        g_cfg['pc'] = 0
+                        g_state['pc'] = 0
                         pc_reset()
                     else:
-                        g_cfg['pc'] = cnt_in - cnt_out
-                    logging.info('Updating parking counter: %d', g_cfg['pc'])
-                    update_pc()
-        mbc.close()
-        time.sleep(g_cfg['pc_interval'])
-
-def scan_th_fn():
-    """Thread function for check scan module"""
-    open_com()
-    dbfn = __file__.replace('.py', '.sqlite')
-    conn = sqlite3.connect(dbfn)
-    cursor = conn.cursor()
+                        g_state['pc'] = cnt_in - cnt_out
+                    logging.info('Updating parking counter: %d', g_state['pc'])
+                    update_occupancy()
+                    publish_pc()
+                    t_change = time.monotonic()
+                    dirty = True
+        now = time.monotonic()
+        if dirty and now - t_save >= g_cfg['pc_save_delay']:
+            with pc_lock:
+                update_pc()
+            t_save = now
+            dirty = False
+        if now - t_change < g_cfg['pc_fast_time']:
+            time.sleep(g_cfg['pc_interval_fast'])
+        else:
+            time.sleep(g_cfg['pc_interval'])
+
+def read_frames(lane):
+    """Read complete frames from lane serial port
+
+    Blocks on the port and reads everything available at once. A frame ends
+    on the scanner terminator or when no byte comes within scan_gap seconds.
+    Yields (frame, t_first) where t_first is perf_counter() of the first byte.
+    """
+    buf = bytearray()
+    t_first = None
     while True:
-        data = ''
+        supervisor.heartbeat()
+        port = lane.serial
+        if port is None:
+            # port did not open, the supervisor restarts the reader later
+            return
         try:
-            while g_cfg['serial'].inWaiting() > 0:
-                try:
-                    data += g_cfg['serial'].read(1).decode("utf-8")
-                except UnicodeDecodeError:
-                    pass
+            chunk = port.read(port.in_waiting or 1)
         except serial.SerialException:
-            open_com()
+            buf = bytearray()
+            t_first = None
+            supervisor.heartbeat()
+            port.close()
+            open_com(lane)
+            continue
+        if chunk:
+            if t_first is None:
+                t_first = time.perf_counter()
+            buf.extend(chunk)
+            terminator = lane.cfg.scan_terminator
+            while True:
+                pos = buf.find(terminator)
+                if pos < 0:
+                    break
+                frame = bytes(buf[:pos])
+                del buf[:pos + len(terminator)]
+                metrics.observe('szpark_frame_read_seconds', time.perf_counter() - t_first, lane=lane.name)
+                yield frame, t_first
+                t_first = time.perf_counter() if buf else None
+            if len(buf) > SCAN_MAX_FRAME:
+                logging.info('Dropping oversized frame (%d bytes)', len(buf))
+                buf = bytearray()
+                t_first = None
+        elif buf:
+            # inter-byte gap: the scanner is done with this frame
+            frame = bytes(buf)
+            buf = bytearray()
+            metrics.observe('szpark_frame_read_seconds', time.perf_counter() - t_first, lane=lane.name)
+            yield frame, t_first
+            t_first = None
+
+def online_fetch(ch_fp, ch_sum):
+    """Ask online service for check, return True if it was found"""
+    r = g_state['online_session'].get(g_cfg['online_url'], params={'fp': ch_fp, 's': ch_sum},
+                                    timeout=g_cfg['online_timeout'], stream=True)
+    try:
+        try:
+            found = g_cfg['onlinefound'].encode(r.encoding or 'utf-8')
+        except (UnicodeEncodeError, LookupError):
+            found = g_cfg['onlinefound'].encode('utf-8')
+        # search the body while it arrives, keeping a tail for matches across chunks
+        tail = b''
+        for chunk in r.iter_content(4096):
+            block = tail + chunk
+            if found in block:
+                return True
+            tail = block[-len(found):]
+        return False
+    finally:
+        r.close()
+
+def online_check(ch_fp, ch_sum):
+    """Check online with deadline, return True/False or None if no answer in time"""
+    key = (ch_fp, ch_sum)
+    if g_state['online_cache'].get(key):
+        return True
+    future = g_state['online_executor'].submit(online_fetch, ch_fp, ch_sum)
+    try:
+        found = future.result(timeout=g_cfg['online_timeout'])
+    except FutureTimeout:
+        logging.info('Online check timed out')
+        return None
+    except requests.RequestException as e:
+        logging.info('Online check failed: %s', e)
+        return None
+    # only positive answers are cached, a new check may appear online later
+    if found:
+        g_state['online_cache'].put(key, True)
+    return found
+
+def online_th_fn():
+    """Thread function for background online recheck"""
+    while True:
+        supervisor.heartbeat()
+        try:
+            row_key, ch_fp, ch_sum, attempt = g_state['q_online'].get(timeout=SUP_BEAT_INTERVAL)
+        except queue.Empty:
+            continue
+        try:
+            found = online_fetch(ch_fp, ch_sum)
+        except requests.RequestException as e:
+            logging.info('Online recheck failed (attempt %d): %s', attempt, e)
+            if attempt < ONLINE_RETRIES:
+                time.sleep(g_cfg['online_timeout'])
+                g_state['q_online'].offer((row_key, ch_fp, ch_sum, attempt + 1))
+            continue
+        if found:
+            g_state['online_cache'].put((ch_fp, ch_sum), True)
+            g_state['q_write'].offer((SQL_ONLINE_OK, row_key))
+        else:
+            g_state['q_write'].offer((SQL_ONLINE_FAIL, row_key))
+        logging.info('Online recheck: fp:%s sum:%s found:%s', ch_fp, ch_sum, found)
+
+def process_frame(data, t_first, lane):
+    """Decode and validate one scanned frame, open lane barrier and queue it for storing"""
+    cfg = g_cfg
+    logging.info('Reading raw data (lane %s):%s', lane.name, data)
+    with metrics.timer('szpark_parse_seconds'):
+        check = cfg['validator'].validate(data, time.time())
+    logging.info('Decoding check: date:%s sum:%s fn:%s (%s) fd:%s fp:%s type:%s',
+                 time.ctime(check.ch_date) if check.ch_date else None,
+                 check.s, check.ch_fn, check.label, check.ch_fd, check.fp, check.ch_t)
+    result = check.result
+    # checking multiple use
+    if not cfg['multiple']:
+        with metrics.timer('szpark_dup_check_seconds'):
+            used = g_state['dup_index'].check_add((check.ch_fn, check.ch_fd, check.ch_fp), check.date)
+        if used:
+            result = result | R_FAIL_MULTI
+    # checking online
+    recheck = False
+    if cfg['online']:
+        with metrics.timer('szpark_online_check_seconds'):
+            found = online_check(check.fp, check.s)
+        if found is None:
+            # no answer in time: decide by policy and verify in background
+            recheck = True
+            if not cfg['online_failopen']:
+                result = result | R_FAIL_ONLINE
+        elif not found:
+            result = result | R_FAIL_ONLINE
+    # log result
+    if result != R_OK:
+        logging.info(result_decode(result))
+    if result == R_OK:
+        logging.info("OK: opening parking (lane %s)", lane.name)
+        open_parking(lane)
+        if 'first_scan' not in g_state:
+            g_state['first_scan'] = time.perf_counter() - T_START
+            logging.info('First accepted scan %.0f ms after start', g_state['first_scan'] * 1000)
+    latency = time.perf_counter() - t_first
+    metrics.observe('szpark_decision_seconds', latency, lane=lane.name)
+    metrics.inc('szpark_scans_total', lane=lane.name, result='ok' if result == R_OK else 'fail')
+    g_state['scan_latency'] = latency * 1000
+    lane.count(result, g_state['scan_latency'])
+    g_state['live'].publish('scan', {
+        'lane': lane.name, 'lane_status': lane.status(), 'time': time.strftime('%H:%M:%S'),
+        'result': result_decode(result, True), 'latency': g_state['scan_latency']})
+    logging.info('Frame latency: %.1f ms', g_state['scan_latency'])
+    # store in base (after the barrier decision)
+    g_state['q_write'].offer((SQL_INSERT, tuple(check._replace(result=result)[:9])))
+    if recheck:
+        g_state['q_online'].offer(((check.date, check.ch_fd, check.ch_fp), check.fp, check.s, 1))
+
+def scan_th_fn(lane):
+    """Thread function for lane check scan module (reader stage)"""
+    open_com(lane)
+    for frame, t_first in read_frames(lane):
+        data = frame.decode('utf-8', errors='ignore').strip()
         if data != '':
-            data = data.strip()
-            logging.info('Reading raw data:%s', data)
-            result = R_OK
-            # decoding string
-            data_s = data.split('&')
-            if len(data_s) != 6:
-                continue
-            try:
-                ch_date = datetime.strptime(data_s[0][:15], 't=%Y%m%dT%H%M')
-            except ValueError:
-                ch_date = ''
-            ch_sum = data_s[1].replace('s=', '')
-            ch_fn = data_s[2].replace('fn=', '')
-            ch_fd = data_s[3].replace('i=', '')
-            ch_fp = data_s[4].replace('fp=', '')
-            ch_t = int(data_s[5].replace('n=', ''))
-            logging.info('Decoding check: date:%s sum:%s fn:%s fd:%s fp:%s type:%s',
-                         ch_date, ch_sum, ch_fn, ch_fd, ch_fp, ch_t)
-            date = datetime.now()
-            # checking multiple use
-            if not g_cfg['multiple']:
-                cursor.execute('SELECT * FROM cache WHERE data = ?', (data,))
-                if cursor.fetchone() != None:
-                    result = result + R_FAIL_MULTI
-            # checking time interval
-            if (date - ch_date) > g_cfg['interval']:
-                result = result + R_FAIL_TIME
-            # checking online
-            if g_cfg['online']:
-                payload = {'fp': ch_fp, 's': ch_sum}
-                r = requests.get('http://receipt.taxcom.ru/v01/show', params=payload)
-                if g_cfg['onlinefound'] in r.text:
-                    pass
-                else:
-                    result = result + R_FAIL_ONLINE
-            # checking type
-            if ch_t != 1:
-                result = result + R_FAIL_TYPE
-            # checking fn
-            if ch_fn not in g_cfg['fns']:
-                result = result + R_FAIL_FN
-            # store in base
-            cursor.execute('INSERT INTO cache(data, date, result, ch_date, ch_sum, ch_fn, ch_fd, ch_fp, ch_t)\
-                VALUES (?,?,?,?,?,?,?,?,?)', (data, date, result, ch_date, ch_sum, ch_fn, ch_fd, ch_fp, ch_t))
-            conn.commit()
-            # log result
-            if result != R_OK:
-                logging.info(result_decode(result))
-            if result == R_OK:
-                logging.info("OK: opening parking")
-                th_open = threading.Thread(target=open_parking, args=())
-                th_open.start()
-        time.sleep(g_cfg['scan_interval'])
-    cursor.close()
-    conn.close()
-    g_cfg['serial'].close()
+            g_state['q_scan'].offer((data, t_first, lane))
+    lane.close()
+
+def valid_th_fn():
+    """Thread function for check validation stage"""
+    while True:
+        supervisor.heartbeat()
+        try:
+            data, t_first, lane = g_state['q_scan'].get(timeout=SUP_BEAT_INTERVAL)
+        except queue.Empty:
+            continue
+        try:
+            process_frame(data, t_first, lane)
+        except (ValueError, TypeError) as e:
+            metrics.inc('szpark_scans_total', lane=lane.name, result='invalid')
+            logging.info('Invalid check data: %s', e)
+
+def retention_th_fn():
+    """Thread function for moving old checks to monthly archive bases"""
+    while True:
+        if g_cfg['archive_days'] > 0:
+            before = int(time.time()) - g_cfg['archive_days'] * 86400
+            g_state['q_write'].offer((g_state['db'].archive, (before,)))
+        time.sleep(DB_RETENTION_INTERVAL)
+
+def write_th_fn():
+    """Thread function for base writer stage"""
+    g_state['db'].write_loop()
+
+def online_init():
+    """Import requests and create online check session, cache and recheck thread"""
+    global requests # pylint: disable=global-statement,invalid-name
+    import requests # pylint: disable=import-outside-toplevel,redefined-outer-name
+    g_state['online_session'] = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=g_cfg['online_pool'])
+    g_state['online_session'].mount('http://', adapter)
+    g_state['online_session'].mount('https://', adapter)
+    g_state['online_executor'] = ThreadPoolExecutor(max_workers=g_cfg['online_pool'])
+    g_state['online_cache'] = OnlineCache(g_cfg['online_cache_size'], g_cfg['online_cache_ttl'])
+    g_state['q_online'] = StageQueue('Online recheck', g_cfg['write_queue'])
+    supervisor.add('online', online_th_fn,
+                   stall=lambda: max(g_cfg['watch_stall'], 2 * g_cfg['online_timeout'] + SUP_BEAT_INTERVAL))
+
+def startup_mark(phase):
+    """Remember end of startup phase (sec since process start)"""
+    g_state['startup'][phase] = time.perf_counter() - T_START
+
+def startup_status():
+    """Startup phase durations and time to first accepted scan as text"""
+    parts = []
+    prev = 0
+    for phase, t_end in list(g_state['startup'].items()):
+        parts.append('{} {:.0f} ms'.format(phase, (t_end - prev) * 1000))
+        prev = t_end
+    text = '{} (ready in {:.0f} ms)'.format(', '.join(parts), prev * 1000)
+    if 'first_scan' in g_state:
+        return text + ', first accepted scan {:.0f} ms'.format(g_state['first_scan'] * 1000)
+    return text + ', no accepted scan yet'
 
 def init():
-    """Init data and main threads"""
-    g_cfg['fn'] = __file__.replace('.py', '.ini')
-    read_cfg()
+    """Start service: gate-critical scan path first, the rest after it
+
+    Serial ports are opened and the modbus session connects in their own
+    threads while the base and multiple use index load.
+    """
+    global g_cfg, users # pylint: disable=global-statement
+    startup_mark('imports')
+    g_cfg = read_cfg(__file__.replace('.py', '.ini'))
+    setup_logging(g_cfg)
+    users = {g_cfg['www_login']: g_cfg['www_pass']}
+    g_state['cfg_time'] = time.time()
+    startup_mark('config')
+    # scan path: barrier session, readers, base, index, validators
+    g_state['mb'] = ModbusSession(g_cfg['mbcip'], g_cfg['mbcport'])
+    g_state['pulse'] = PulseScheduler(g_state['mb'])
+    g_state['q_scan'] = StageQueue('Scan', g_cfg['scan_queue'])
+    g_state['lanes'] = OrderedDict()
+    for lane_cfg in g_cfg['lanes'].values():
+        lane_start(lane_cfg)
+    startup_mark('lanes')
     dbfn = __file__.replace('.py', '.sqlite')
-    conn = sqlite3.connect(dbfn)
-    cursor = conn.cursor()
-    cursor.execute("""CREATE TABLE IF NOT EXISTS cache(
-        data TEXT,
-        date TEXT,
-        result INT,
-        ch_date TEXT,
-        ch_sum TEXT,
-        ch_fn TEXT,
-        ch_fd TEXT,
-        ch_fp TEXT,
-        ch_t INT)""")
-    cursor.execute('CREATE INDEX IF NOT EXISTS data ON cache (data)')
-    cursor.execute('CREATE TABLE IF NOT EXISTS pc(value INT)')
-    conn.commit()
-    g_cfg['th_scan'] = threading.Thread(target=scan_th_fn, args=())
-    g_cfg['th_scan'].start()
+    g_state['db'] = Storage(dbfn, g_cfg['write_queue'], g_cfg['db_commit_interval'])
+    g_state['db'].migrate()
+    g_state['q_write'] = g_state['db'].queue
+    g_state['db_ro'] = ReadPool(dbfn, g_cfg['www_threads'])
+    g_state['live_slots'] = threading.BoundedSemaphore(g_cfg['live_clients'])
+    supervisor.add('write', write_th_fn, stall=lambda: g_cfg['watch_stall'], cleanup=g_state['db'].reconnect)
+    startup_mark('base')
+    apply_cfg()
+    g_state['valid_workers'] = g_cfg['scan_workers']
+    for i in range(g_state['valid_workers']):
+        supervisor.add('valid:{}'.format(i), valid_th_fn,
+                       stall=lambda: max(g_cfg['watch_stall'], 2 * g_cfg['online_timeout'] + SUP_BEAT_INTERVAL))
+    startup_mark('validation')
+    # the rest: parking counter, archive, watchdog and config reload
+    g_state['pc_reads'] = RateCounter()
+    g_state['pc_writes'] = RateCounter()
     if g_cfg['pc_enable']:
         # init parking counter from ini file if does not exist data in db
-        cursor.execute('SELECT value FROM pc')
-        result = cursor.fetchone()
+        result = g_state['db'].conn.execute('SELECT value FROM pc').fetchone()
         if result:
-            g_cfg['pc'] = result[0]
+            g_state['pc'] = result[0]
         else:
-            g_cfg['pc'] = g_cfg['pc_init']
-        g_cfg['th_pc'] = threading.Thread(target=pc_th_fn, args=())
-        g_cfg['th_pc'].start()
+            g_state['pc'] = g_cfg['pc_init']
+        supervisor.add('pc', pc_th_fn, stall=lambda: max(
+            g_cfg['watch_stall'], g_cfg['pc_interval'] + MB_CALL_TIMEOUT + SUP_BEAT_INTERVAL))
+    g_state['th_retention'] = threading.Thread(target=retention_th_fn, args=())
+    g_state['th_retention'].daemon = True
+    g_state['th_retention'].start()
     if g_cfg['watchdog']:
-        g_cfg['th_watch'] = threading.Thread(target=watch_th_fn, args=())
-        g_cfg['th_watch'].start()
-    cursor.close()
-    conn.close()
-
-init()
-logging.info('Starting service')
-app.run(host=g_cfg['www_addr'], port=g_cfg['www_port'])
\ No newline at end of file
+        g_state['th_watch'] = threading.Thread(target=watch_th_fn, args=())
+        g_state['th_watch'].start()
+    g_state['th_cfg'] = threading.Thread(target=cfg_th_fn, args=())
+    g_state['th_cfg'].daemon = True
+    g_state['th_cfg'].start()
+    startup_mark('services')
+
+def serve():
+    """Run web interface with selected server"""
+    if g_cfg['www_server'] == 'waitress':
+        try:
+            import waitress # pylint: disable=import-outside-toplevel
+        except ImportError:
+            logging.info('waitress is not installed, using flask server')
+        else:
+            waitress.serve(app, host=g_cfg['www_addr'], port=g_cfg['www_port'], threads=g_cfg['www_threads'] + g_cfg['live_clients'])
+            return
+    app.run(host=g_cfg['www_addr'], port=g_cfg['www_port'], threaded=True)
+
+def cmd_export(args):
+    """Write checks history of base to file"""
+    fmt = export_format(args.file, args.format)
+    date1, date2 = export_range(args.date_from, args.date_to)
+    pool = ReadPool(args.base, 1)
+    t_start = time.perf_counter()
+    count = [0]
+
+    def chunks():
+        """Count rows on the way"""
+        for rows in export_chunks(pool.connection, date1, date2):
+            count[0] = count[0] + len(rows)
+            yield rows
+
+    f_out = sys.stdout.buffer if args.file == '-' else open(args.file, 'wb')
+    try:
+        for data in EXPORT_FORMATS[fmt][2](chunks()):
+            f_out.write(data)
+    finally:
+        if f_out is not sys.stdout.buffer:
+            f_out.close()
+    elapsed = time.perf_counter() - t_start
+    print('Exported {} checks ({}) in {:.1f} s: {:.0f} rows/s'.format(
+        count[0], fmt, elapsed, count[0] / max(elapsed, 1e-6)), file=sys.stderr)
+
+def cmd_import(args):
+    """Load checks history from file into base"""
+    fmt = export_format(args.file, args.format)
+    db = Storage(args.base, 1, 0)
+    db.migrate()
+    t_start = time.perf_counter()
+    with (sys.stdin.buffer if args.file == '-' else open(args.file, 'rb')) as f_in:
+        count = db.load(EXPORT_FORMATS[fmt][3](f_in))
+    elapsed = time.perf_counter() - t_start
+    db.conn.close()
+    print('Imported {} checks ({}) in {:.1f} s: {:.0f} rows/s'.format(
+        count, fmt, elapsed, count / max(elapsed, 1e-6)), file=sys.stderr)
+    print('Restart the service to load imported checks into the multiple use index', file=sys.stderr)
+
+def main():
+    """Parse command line and run service or base command"""
+    base = __file__.replace('.py', '.sqlite')
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('serve', help='run service (default)')
+    export = sub.add_parser('export', help='write checks history to file')
+    export.add_argument('file', help='output file, - for stdout')
+    export.add_argument('--from', dest='date_from', help='first scan date (YYYY-MM-DD)')
+    export.add_argument('--to', dest='date_to', help='last scan date (YYYY-MM-DD)')
+    export.set_defaults(fn=cmd_export)
+    load = sub.add_parser('import', help='load checks history from file')
+    load.add_argument('file', help='input file, - for stdin')
+    load.set_defaults(fn=cmd_import)
+    for cmd in (export, load):
+        cmd.add_argument('--format', choices=list(EXPORT_FORMATS), help='file format (default by extension, csv)')
+        cmd.add_argument('--base', default=base, help='base file, also monthly archive bases (default: service base)')
+    args = parser.parse_args()
+    if not hasattr(args, 'fn'):
+        init()
+        logging.info('Starting service, startup: %s', startup_status())
+        serve()
+        return
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    try:
+        args.fn(args)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        parser.exit(1, '{} failed: {}\n'.format(args.command, e))
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,772 @@
+# pylint: disable=C0103,C0301,R0914
+"""SZ Parking Service benchmarks"""
+import os
+import re
+import sys
+import json
+import logging
+import random
+import time
+import base64
+import shutil
+import socket
+import struct
+import sqlite3
+import tempfile
+import threading
+import subprocess
+import socketserver
+import http.server
+from collections import Counter
+from datetime import datetime, timedelta
+import argparse
+import configparser
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+def percentile(values, pct):
+    """Percentile of sorted values"""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def read_ini(fn):
+    """Read service config"""
+    config = configparser.ConfigParser()
+    config.read(fn, encoding='utf-8-sig')
+    return config['szpark']
+
+def bench_web(args):
+    """Load test of web interface pages"""
+    cfg = read_ini(args.ini)
+    url = args.url or 'http://127.0.0.1:{}'.format(cfg.get('www_port'))
+    token = base64.b64encode('{}:{}'.format(cfg.get('www_login'), cfg.get('www_pass')).encode('utf-8'))
+    headers = {'Authorization': 'Basic ' + token.decode('ascii')}
+
+    def fetch(path):
+        """Request page, return latency (sec) or None on error"""
+        t_start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url + path, headers=headers), timeout=30) as r:
+                r.read()
+        except (urllib.error.URLError, OSError):
+            return None
+        return time.perf_counter() - t_start
+
+    print('{:8} {:>10} {:>10} {:>10} {:>8}'.format('page', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for path in args.paths:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            t_start = time.perf_counter()
+            results = list(executor.map(fetch, [path] * args.requests))
+            elapsed = time.perf_counter() - t_start
+        latencies = sorted(r for r in results if r is not None)
+        print('{:8} {:10.1f} {:10.1f} {:10.1f} {:8}'.format(
+            path, len(latencies) / elapsed, percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000, len(results) - len(latencies)))
+
+def bench_db(args):
+    """Insert throughput and reader latency while writes are running"""
+    import szpark # pylint: disable=import-outside-toplevel
+    tmp = tempfile.mkdtemp()
+    modes = (('rollback journal, commit per row', False, 0),
+             ('wal, group commit', True, args.commit_interval))
+    print('{:34} {:>10} {:>12} {:>12} {:>8} {:>8}'.format('mode', 'rows/s', 'read p50 ms', 'read p99 ms', 'reads', 'locked'))
+    for n, (name, wal, interval) in enumerate(modes):
+        dbfn = os.path.join(tmp, 'bench{}.sqlite'.format(n))
+        db = szpark.Storage(dbfn, args.rows + 1, interval, wal=wal)
+        db.migrate()
+        threading.Thread(target=db.write_loop, daemon=True).start()
+        pool = szpark.ReadPool(dbfn, 1)
+        done = threading.Event()
+        latencies = []
+        errors = []
+
+        def read():
+            """Run base page queries until writing is done"""
+            while not done.wait(args.read_interval):
+                t_start = time.perf_counter()
+                try:
+                    with pool.connection() as conn:
+                        conn.execute('SELECT COUNT(*) FROM checks WHERE date >= ?', (0,)).fetchone()
+                        conn.execute('SELECT * FROM checks ORDER BY date DESC LIMIT 100').fetchall()
+                except sqlite3.OperationalError:
+                    errors.append(t_start)
+                    continue
+                latencies.append(time.perf_counter() - t_start)
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        t_start = time.perf_counter()
+        for i in range(args.rows):
+            data = 't=20180101T1200&s=100.00&fn=8712000100125378&i={}&fp={}&n=1'.format(i, 1000000000 + i)
+            db.queue.put((szpark.SQL_INSERT, szpark.check_row(data, datetime.now(), 0, datetime(2018, 1, 1, 12), '100.00',
+                                                              '8712000100125378', str(i), str(1000000000 + i), 1)))
+        db.flush()
+        elapsed = time.perf_counter() - t_start
+        done.set()
+        reader.join()
+        latencies.sort()
+        print('{:34} {:10.1f} {:12.2f} {:12.2f} {:8} {:8}'.format(
+            name, args.rows / elapsed, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+            len(latencies), len(errors)))
+
+def qr_corpus(fns):
+    """Generated check QR codes: valid, reordered, with extra fields and malformed"""
+    now = datetime.now()
+    corpus = []
+    for i, fn in enumerate(fns):
+        t = (now - timedelta(minutes=i)).strftime('%Y%m%dT%H%M')
+        fields = ['t=' + t, 's={}.00'.format(100 + i), 'fn={}'.format(fn), 'i={}'.format(1000 + i),
+                  'fp={}'.format(2000000000 + i), 'n=1']
+        corpus.append('&'.join(fields))
+        corpus.append('&'.join(reversed(fields)))
+        corpus.append('&'.join(fields + ['x=1']))
+        corpus.append('&'.join(fields[:-1] + ['n=2']))
+    corpus += [
+        't=20180101T1200&s=100.00&fn=1234567890123456&i=1&fp=1&n=1',
+        't=2018&s=1&fn=x&i=y&fp=z&n=q',
+        't=20180101T1200&s=100.00&fn=1234567890123456',
+        'garbage',
+        '',
+    ]
+    return corpus
+
+def bench_validate(args):
+    """Validations per second on a corpus of check QR codes"""
+    import szpark # pylint: disable=import-outside-toplevel
+    config = configparser.ConfigParser()
+    config.read(args.ini, encoding='utf-8-sig')
+    fns = szpark.read_fns(config, args.ini)
+    if args.corpus:
+        with open(args.corpus, encoding='utf-8') as f_corpus:
+            corpus = [line.strip() for line in f_corpus if line.strip()]
+    else:
+        corpus = qr_corpus(fns)
+    validator = szpark.CheckValidator(fns, timedelta(seconds=config.getint('szpark', 'interval')))
+    now = time.time()
+    valid = 0
+    t_start = time.perf_counter()
+    for _ in range(args.rounds):
+        for data in corpus:
+            try:
+                validator.validate(data, now)
+                valid = valid + 1
+            except ValueError:
+                pass
+    elapsed = time.perf_counter() - t_start
+    total = args.rounds * len(corpus)
+    print('{} validations ({} decoded, {} malformed) in {:.3f} s: {:.0f} validations/s, {:.2f} us each'.format(
+        total, valid, total - valid, elapsed, total / elapsed, elapsed / total * 1e6))
+
+def history_rows(count, days):
+    """Generated checks rows of several fns spread over days, mostly valid"""
+    rnd = random.Random(1)
+    fns = [8712000100125378 + i for i in range(8)]
+    start = int(time.time()) - days * 86400
+    step = days * 86400.0 / count
+    for i in range(count):
+        date = start + int(i * step)
+        fn = fns[i % len(fns)]
+        result = 0 if i % 20 else 2
+        yield (date, result, date - rnd.randint(60, 7200), rnd.randint(5000, 500000), fn, 1000 + i // len(fns),
+               rnd.randint(10 ** 9, 4 * 10 ** 9), 1, None if i % 100 else 'raw&i={}'.format(i))
+
+def bench_export(args):
+    """Bulk import, export and re-import throughput for each history format"""
+    import szpark # pylint: disable=import-outside-toplevel
+    tmp = tempfile.mkdtemp()
+    try:
+        dbfn = os.path.join(tmp, 'history.sqlite')
+        db = szpark.Storage(dbfn, 1, 0)
+        db.migrate()
+        t_start = time.perf_counter()
+        db.load(history_rows(args.rows, args.days))
+        elapsed = time.perf_counter() - t_start
+        print('generated {} rows, bulk load {:.0f} rows/s, base {:.1f} MiB'.format(
+            args.rows, args.rows / elapsed, db.size() / 1048576.0))
+        pool = szpark.ReadPool(dbfn, 1)
+        szpark.g_state['db_ro'] = pool
+        szpark.users = {'bench': 'bench'}
+        client = szpark.app.test_client()
+        headers = {'Authorization': 'Basic ' + base64.b64encode(b'bench:bench').decode('ascii')}
+        print('{:8} {:>12} {:>12} {:>12} {:>10} {:>10}'.format(
+            'format', 'export r/s', 'web r/s', 'import r/s', 'MiB', 'bytes/row'))
+        for fmt, (_, ext, writer, reader) in szpark.EXPORT_FORMATS.items():
+            fn = os.path.join(tmp, 'history' + ext)
+            t_start = time.perf_counter()
+            with open(fn, 'wb') as f_out:
+                for data in writer(szpark.export_chunks(pool.connection)):
+                    f_out.write(data)
+            t_export = time.perf_counter() - t_start
+            t_start = time.perf_counter()
+            size = 0
+            response = client.get('/export?format=' + fmt, headers=headers, buffered=False)
+            for data in response.response:
+                size = size + len(data)
+            response.close()
+            t_web = time.perf_counter() - t_start
+            target = szpark.Storage(os.path.join(tmp, 'import_{}.sqlite'.format(fmt)), 1, 0)
+            target.migrate()
+            t_start = time.perf_counter()
+            with open(fn, 'rb') as f_in:
+                count = target.load(reader(f_in))
+            t_import = time.perf_counter() - t_start
+            same = target.conn.execute('SELECT COUNT(*), SUM(date), SUM(ch_fp), COUNT(raw) FROM checks').fetchone() == \
+                db.conn.execute('SELECT COUNT(*), SUM(date), SUM(ch_fp), COUNT(raw) FROM checks').fetchone()
+            target.conn.close()
+            print('{:8} {:12.0f} {:12.0f} {:12.0f} {:10.1f} {:10.1f}{}'.format(
+                fmt, args.rows / t_export, args.rows / t_web, count / t_import, os.path.getsize(fn) / 1048576.0,
+                os.path.getsize(fn) / float(args.rows), '' if same and size == os.path.getsize(fn) else '  MISMATCH'))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+class VirtualScanner(object):
+    """Virtual serial device: TCP server the service reads from as socket://host:port
+
+    Sends QR payloads ended with CR at a fixed rate once started.
+    """
+    def __init__(self, payloads, rate):
+        self.payloads = payloads
+        self.rate = rate
+        self.sent = 0
+        self.conn = None
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.connected = threading.Event()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        """Take service connections (the service reconnects after port errors)"""
+        while True:
+            conn, _ = self.server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.conn = conn
+            self.connected.set()
+
+    def run(self, duration):
+        """Send payloads for duration seconds"""
+        t_start = time.perf_counter()
+        while True:
+            t_next = t_start + self.sent / self.rate
+            if t_next - t_start >= duration:
+                break
+            time.sleep(max(0, t_next - time.perf_counter()))
+            data = self.payloads[self.sent % len(self.payloads)]
+            try:
+                self.conn.sendall(data(self.sent).encode('utf-8') + b'\r')
+            except OSError:
+                self.connected.clear()
+                self.connected.wait(5)
+                continue
+            self.sent = self.sent + 1
+
+class ModbusStandIn(socketserver.ThreadingTCPServer):
+    """Modbus TCP controller simulating coils and parking counter registers
+
+    Every barrier coil switched on counts a car in; reset coils load the
+    counters from the init registers like the real controller.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, cfg):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), ModbusHandler)
+        self.cfg = cfg
+        self.coils = {}
+        self.holding = {}
+        self.inputs = {}
+        self.requests = Counter()
+        self.opens = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def write_coil(self, addr, value):
+        """Set coil and run its controller side effect"""
+        self.coils[addr] = value
+        if not value:
+            return
+        if addr == self.cfg.getint('mbccoil_reset_in'):
+            self.inputs[self.cfg.getint('mbcreg_in')] = self.holding.get(self.cfg.getint('mbcreg_init_in'), 0)
+        elif addr == self.cfg.getint('mbccoil_reset_out'):
+            self.inputs[self.cfg.getint('mbcreg_out')] = self.holding.get(self.cfg.getint('mbcreg_init_out'), 0)
+        elif addr not in (self.cfg.getint('mbccoil_save'), self.cfg.getint('mbccoil_reset_in') + 1,
+                          self.cfg.getint('mbccoil_reset_out') + 1):
+            self.opens = self.opens + 1
+            reg = self.cfg.getint('mbcreg_in')
+            self.inputs[reg] = (self.inputs.get(reg, 0) + 1) & 0xFFFF
+
+    def execute(self, pdu):
+        """Run request PDU, return response PDU"""
+        fc = pdu[0]
+        self.requests[fc] += 1
+        with self.lock:
+            if fc in (1, 2):
+                addr, count = struct.unpack('>HH', pdu[1:5])
+                bits = bytearray((count + 7) // 8)
+                for i in range(count):
+                    if self.coils.get(addr + i):
+                        bits[i // 8] |= 1 << (i % 8)
+                return bytes([fc, len(bits)]) + bytes(bits)
+            if fc in (3, 4):
+                addr, count = struct.unpack('>HH', pdu[1:5])
+                regs = self.holding if fc == 3 else self.inputs
+                return bytes([fc, count * 2]) + struct.pack('>' + 'H' * count, *[regs.get(addr + i, 0) for i in range(count)])
+            if fc == 5:
+                addr, value = struct.unpack('>HH', pdu[1:5])
+                self.write_coil(addr, value == 0xFF00)
+                return pdu[:5]
+            if fc == 6:
+                addr, value = struct.unpack('>HH', pdu[1:5])
+                self.holding[addr] = value
+                return pdu[:5]
+            if fc == 15:
+                addr, count = struct.unpack('>HH', pdu[1:5])
+                for i in range(count):
+                    self.write_coil(addr + i, bool(pdu[6 + i // 8] >> (i % 8) & 1))
+                return pdu[:5]
+            if fc == 16:
+                addr, count = struct.unpack('>HH', pdu[1:5])
+                for i in range(count):
+                    self.holding[addr + i] = struct.unpack('>H', pdu[6 + i * 2:8 + i * 2])[0]
+                return pdu[:5]
+        return bytes([fc | 0x80, 1])
+
+class ModbusHandler(socketserver.BaseRequestHandler):
+    """One modbus TCP client connection"""
+    def handle(self):
+        while True:
+            header = self.recv(7)
+            if header is None:
+                return
+            tid, pid, length, unit = struct.unpack('>HHHB', header)
+            pdu = self.recv(length - 1)
+            if pdu is None:
+                return
+            response = self.server.execute(pdu)
+            self.request.sendall(struct.pack('>HHHB', tid, pid, len(response) + 1, unit) + response)
+
+    def recv(self, size):
+        """Read exactly size bytes, None on closed connection"""
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data = data + chunk
+        return data
+
+class TaxcomStub(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Online check server answering every check as found after delay seconds"""
+    daemon_threads = True
+
+    def __init__(self, found, delay):
+        self.found = found
+        self.delay = delay
+        self.requests = 0
+        http.server.HTTPServer.__init__(self, ('127.0.0.1', 0), TaxcomHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def handle_error(self, request, client_address):
+        """Clients giving up before a slow answer are expected, no traceback"""
+
+class TaxcomHandler(http.server.BaseHTTPRequestHandler):
+    """Check page request"""
+    def do_GET(self): # pylint: disable=invalid-name
+        """Answer with a page containing the configured found marker"""
+        self.server.requests = self.server.requests + 1
+        time.sleep(self.server.delay)
+        body = '<html><body>{}</body></html>'.format(self.server.found).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+def free_port():
+    """Unused local TCP port"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def set_ini(text, key, value):
+    """Set [szpark] key in ini text keeping comments"""
+    line = '{} = {}'.format(key, value)
+    text, n = re.subn(r'(?m)^{}\s*=.*$'.format(re.escape(key)), line.replace('\\', '\\\\'), text, count=1)
+    if not n:
+        text = text.replace('[szpark]\n', '[szpark]\n' + line + '\n', 1)
+    return text
+
+def parse_metrics(text):
+    """Prometheus text format to list of (name, labels dict, value)"""
+    samples = []
+    for line in text.splitlines():
+        m = re.match(r'^(\w+)(?:\{(.*)\})? (\S+)$', line)
+        if m:
+            samples.append((m.group(1), dict(re.findall(r'(\w+)="([^"]*)"', m.group(2) or '')), float(m.group(3))))
+    return samples
+
+def metric_sum(samples, name, **labels):
+    """Sum of samples matching name and labels"""
+    return sum(value for n, l, value in samples
+               if n == name and all(l.get(k) == v for k, v in labels.items()))
+
+def histogram_quantile(samples, name, q):
+    """Quantile (sec) estimated from histogram buckets summed over all labels"""
+    buckets = {}
+    for n, labels, value in samples:
+        if n == name + '_bucket':
+            le = float(labels['le'])
+            buckets[le] = buckets.get(le, 0) + value
+    bounds = sorted(buckets)
+    if not bounds or not buckets[bounds[-1]]:
+        return 0
+    rank = q * buckets[bounds[-1]]
+    prev_bound, prev_count = 0, 0
+    for bound in bounds:
+        if buckets[bound] >= rank:
+            if bound == float('inf'):
+                return prev_bound
+            return prev_bound + (bound - prev_bound) * (rank - prev_count) / max(buckets[bound] - prev_count, 1)
+        prev_bound, prev_count = bound, buckets[bound]
+    return prev_bound
+
+def proc_usage(pid):
+    """CPU seconds, RSS, peak RSS (KiB) and threads of a process from /proc"""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f_stat:
+            fields = f_stat.read().rsplit(')', 1)[1].split()
+        with open('/proc/{}/status'.format(pid)) as f_status:
+            status = dict(line.split(':', 1) for line in f_status if ':' in line)
+    except OSError:
+        return None
+    return {'cpu': (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK')),
+            'rss': int(status['VmRSS'].split()[0]),
+            'peak_rss': int(status['VmHWM'].split()[0]),
+            'threads': int(status['Threads'])}
+
+def replay_payloads(args, fns):
+    """Payload factories: recorded QR codes or generated unique valid checks"""
+    if args.payloads:
+        with open(args.payloads, encoding='utf-8') as f_payloads:
+            recorded = [line.strip() for line in f_payloads if line.strip()]
+        if not args.retime:
+            return [lambda n, data=data: data for data in recorded]
+        return [lambda n, data=data: re.sub(r't=\d{8}T\d{4}(\d\d)?', 't=' + datetime.now().strftime('%Y%m%dT%H%M'), data)
+                for data in recorded]
+    fn = next(iter(fns), 0)
+    return [lambda n: 't={}&s={}.{:02d}&fn={}&i={}&fp={}&n=1'.format(
+        datetime.now().strftime('%Y%m%dT%H%M'), 50 + n % 500, n % 100, fn, n + 1, 3000000000 + n)]
+
+def bench_replay(args):
+    """End to end run of the service against simulated scanner, controller and taxcom"""
+    import szpark # pylint: disable=import-outside-toplevel
+    config = configparser.ConfigParser()
+    config.read(args.ini, encoding='utf-8-sig')
+    cfg = config['szpark']
+    fns = szpark.read_fns(config, args.ini)
+    payloads = replay_payloads(args, fns)
+    scanners = [VirtualScanner(payloads, args.rate) for _ in range(args.lanes)]
+    mb = ModbusStandIn(cfg)
+    taxcom = TaxcomStub(cfg.get('onlinefound'), args.online_delay)
+    # service copy with its own ini, base and log
+    workdir = tempfile.mkdtemp(prefix='szpark_replay_')
+    shutil.copy(__file__.replace('_bench.py', '.py'), workdir)
+    with open(args.ini, encoding='utf-8-sig') as f_ini:
+        text = f_ini.read()
+    text = re.split(r'(?m)^\[lane\.', text)[0]
+    www_port = free_port()
+    overrides = {'com': 'socket://127.0.0.1:{}'.format(scanners[0].port), 'mbcip': '127.0.0.1', 'mbcport': mb.server_address[1],
+                 'www_addr': '127.0.0.1', 'www_port': www_port, 'online': 'true' if args.online else 'false',
+                 'online_url': 'http://127.0.0.1:{}/v01/show'.format(taxcom.server_address[1]),
+                 'reload_interval': 0, 'watch_interval': 5}
+    if args.server:
+        overrides['www_server'] = args.server
+    for key, value in overrides.items():
+        text = set_ini(text, key, value)
+    if args.lanes > 1:
+        for i, scanner in enumerate(scanners):
+            text = text + '\n[lane.{}]\ncom = socket://127.0.0.1:{}\nmbccoil = {}\n'.format(
+                i + 1, scanner.port, cfg.getint('mbccoil') + i)
+    with open(os.path.join(workdir, 'szpark.ini'), 'w', encoding='utf-8') as f_ini:
+        f_ini.write(text)
+    url = 'http://127.0.0.1:{}'.format(www_port)
+    token = base64.b64encode('{}:{}'.format(cfg.get('www_login'), cfg.get('www_pass')).encode('utf-8'))
+    headers = {'Authorization': 'Basic ' + token.decode('ascii')}
+
+    def fetch(path):
+        """Request page, return (latency sec, body) or None on error"""
+        t_start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url + path, headers=headers), timeout=30) as r:
+                body = r.read()
+        except (urllib.error.URLError, OSError):
+            return None
+        return time.perf_counter() - t_start, body
+
+    with open(os.path.join(workdir, 'stdout.txt'), 'w') as f_out:
+        proc = subprocess.Popen([sys.executable, os.path.join(workdir, 'szpark.py')], cwd=workdir, stdout=f_out, stderr=subprocess.STDOUT)
+    try:
+        t_start = time.perf_counter()
+        while fetch('/') is None:
+            if proc.poll() is not None or time.perf_counter() - t_start > 30:
+                raise SystemExit('service did not start, see {}'.format(workdir))
+            time.sleep(0.1)
+        for scanner in scanners:
+            if not scanner.connected.wait(30):
+                raise SystemExit('service did not open scanner port, see {}'.format(workdir))
+        print('service started in {:.2f} s, workdir {}'.format(time.perf_counter() - t_start, workdir))
+        usage_start = proc_usage(proc.pid)
+        # web clients run alongside the scans
+        web = dict((path, []) for path in args.paths)
+        done = threading.Event()
+
+        def browse():
+            """Request web pages round robin at web_rate"""
+            n = 0
+            while not done.wait(1.0 / args.web_rate if args.web_rate else 1):
+                if not args.web_rate:
+                    continue
+                path = args.paths[n % len(args.paths)]
+                result = fetch(path)
+                web[path].append(result[0] if result else None)
+                n = n + 1
+
+        browser = threading.Thread(target=browse, daemon=True)
+        browser.start()
+        t_start = time.perf_counter()
+        senders = [threading.Thread(target=scanner.run, args=(args.duration,)) for scanner in scanners]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        sent = sum(scanner.sent for scanner in scanners)
+        # wait until the service has decided on every frame
+        deadline = time.perf_counter() + args.drain
+        while True:
+            samples = parse_metrics(fetch('/metrics')[1].decode('utf-8'))
+            processed = metric_sum(samples, 'szpark_scans_total')
+            if processed + metric_sum(samples, 'szpark_queue_dropped_total', queue='Scan') >= sent \
+                    or time.perf_counter() > deadline:
+                break
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - t_start
+        done.set()
+        browser.join()
+        usage = proc_usage(proc.pid)
+    finally:
+        proc.terminate()
+        proc.wait()
+    results = {
+        'lanes': args.lanes,
+        'sent': sent,
+        'processed': processed,
+        'ok': metric_sum(samples, 'szpark_scans_total', result='ok'),
+        'fail': metric_sum(samples, 'szpark_scans_total', result='fail'),
+        'invalid': metric_sum(samples, 'szpark_scans_total', result='invalid'),
+        'dropped': metric_sum(samples, 'szpark_queue_dropped_total'),
+        'scans_per_sec': processed / elapsed,
+        'decision_p50_ms': histogram_quantile(samples, 'szpark_decision_seconds', 0.5) * 1000,
+        'decision_p99_ms': histogram_quantile(samples, 'szpark_decision_seconds', 0.99) * 1000,
+        'frame_read_p99_ms': histogram_quantile(samples, 'szpark_frame_read_seconds', 0.99) * 1000,
+        'db_write_p99_ms': histogram_quantile(samples, 'szpark_db_write_seconds', 0.99) * 1000,
+        'barrier_opens': mb.opens,
+        'modbus_requests': sum(mb.requests.values()),
+        'pc_polls': metric_sum(samples, 'szpark_pc_poll_seconds_count'),
+        'online_requests': taxcom.requests,
+        'startup_ready_ms': max([value for n, l, value in samples if n == 'szpark_startup_seconds'
+                                 and l['phase'] != 'first_accepted_scan'] or [0]) * 1000,
+        'first_scan_ms': metric_sum(samples, 'szpark_startup_seconds', phase='first_accepted_scan') * 1000,
+        'web': {},
+    }
+    print('sent {} frames on {} lane(s) at {:.1f}/s per lane'.format(sent, args.lanes, args.rate))
+    print('processed {processed:.0f} scans in {0:.1f} s: {ok:.0f} ok, {fail:.0f} rejected, {invalid:.0f} invalid, '
+          '{dropped:.0f} dropped -> {scans_per_sec:.1f} scans/s'.format(elapsed, **results))
+    print('decision latency p50 {decision_p50_ms:.2f} ms, p99 {decision_p99_ms:.2f} ms; frame read p99 {frame_read_p99_ms:.2f} ms; '
+          'base write p99 {db_write_p99_ms:.2f} ms'.format(**results))
+    print('service startup: ready in {startup_ready_ms:.0f} ms, first accepted scan {first_scan_ms:.0f} ms after '
+          'process start'.format(**results))
+    print('controller: {barrier_opens} barrier opens, {modbus_requests} modbus requests, {pc_polls:.0f} counter polls; '
+          'taxcom: {online_requests} requests'.format(**results))
+    for path, latencies in web.items():
+        ok = sorted(latency for latency in latencies if latency is not None)
+        results['web'][path] = {'p50_ms': percentile(ok, 50) * 1000, 'p99_ms': percentile(ok, 99) * 1000,
+                                'requests': len(latencies), 'errors': len(latencies) - len(ok)}
+        print('web {:8} p50 {p50_ms:8.1f} ms, p99 {p99_ms:8.1f} ms, {requests} requests, {errors} errors'.format(
+            path, **results['web'][path]))
+    if usage and usage_start:
+        results['cpu_percent'] = (usage['cpu'] - usage_start['cpu']) * 100 / elapsed
+        results['rss_kib'] = usage['rss']
+        results['peak_rss_kib'] = usage['peak_rss']
+        results['threads'] = usage['threads']
+        print('service: cpu {cpu_percent:.1f}%, rss {0:.1f} MiB (peak {1:.1f} MiB), {threads} threads'.format(
+            usage['rss'] / 1024.0, usage['peak_rss'] / 1024.0, **results))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f_json:
+            json.dump(results, f_json, indent=2)
+
+def check_online(args):
+    """Online check behaviour against the stub taxcom server with a deadline below its delay
+
+    Runs online_check, process_frame and the recheck thread in process and
+    exits with status 1 if any expectation fails.
+    """
+    import szpark # pylint: disable=import-outside-toplevel
+    logging.basicConfig(level=logging.WARNING)
+    config = configparser.ConfigParser()
+    config.read(args.ini, encoding='utf-8-sig')
+    ini = config['szpark']
+    taxcom = TaxcomStub(ini.get('onlinefound'), 0.01)
+    mb = ModbusStandIn(ini)
+    tmp = tempfile.mkdtemp()
+    cfg = dict(szpark.read_cfg(args.ini))
+    cfg.update({'online': True, 'online_url': 'http://127.0.0.1:{}/v01/show'.format(taxcom.server_address[1]),
+                'online_timeout': args.timeout, 'online_cache_size': 2, 'online_cache_ttl': 1, 'multiple': True})
+    szpark.g_cfg = szpark.MappingProxyType(cfg)
+    db = szpark.Storage(os.path.join(tmp, 'online.sqlite'), 1000, 0.05)
+    db.migrate()
+    threading.Thread(target=db.write_loop, daemon=True).start()
+    szpark.g_state.update({'db': db, 'q_write': db.queue, 'mb': szpark.ModbusSession('127.0.0.1', mb.server_address[1])})
+    szpark.g_state['pulse'] = szpark.PulseScheduler(szpark.g_state['mb'])
+    szpark.online_init()
+    lane = szpark.Lane(next(iter(cfg['lanes'].values())))
+    fn = next(iter(cfg['fns']), 0)
+    failed = []
+
+    def expect(name, ok, detail=''):
+        """Print check result"""
+        print('{:4} {}{}'.format('ok' if ok else 'FAIL', name, '' if ok else ': ' + str(detail)))
+        if not ok:
+            failed.append(name)
+
+    def wait_for(fn_ok, timeout=5):
+        """Poll until fn_ok() is true or timeout (sec), return its last value"""
+        deadline = time.monotonic() + timeout
+        while not fn_ok() and time.monotonic() < deadline:
+            time.sleep(0.02)
+        return fn_ok()
+
+    def scan(n, failopen, delay, found):
+        """Process one check with the given policy and stub answer, return (barrier opened, accepted)
+
+        The stub answers the background recheck in time with found.
+        """
+        szpark.g_cfg = szpark.MappingProxyType(dict(cfg, online_failopen=failopen))
+        taxcom.delay = delay
+        opens = mb.opens
+        accepted = lane.accepted
+        data = 't={}&s=100.00&fn={}&i={}&fp={}&n=1'.format(datetime.now().strftime('%Y%m%dT%H%M'), fn, n, 4000000000 + n)
+        szpark.process_frame(data, time.perf_counter(), lane)
+        accepted = lane.accepted > accepted
+        taxcom.delay = 0.01
+        taxcom.found = ini.get('onlinefound') if found else 'not here'
+        wait_for(lambda: mb.opens > opens, 0.5)
+        return mb.opens > opens, accepted
+
+    def stored(n, result):
+        """Wait until the stored row of check n has result"""
+        return wait_for(lambda: (db.conn.execute('SELECT result FROM checks WHERE ch_fd = ?', (n,)).fetchone() or (None,))[0] == result)
+
+    # answers and cache
+    szpark.g_cfg = szpark.MappingProxyType(cfg)
+    requests_before = taxcom.requests
+    expect('found check', szpark.online_check('1', '1.00') is True)
+    expect('found answer cached', szpark.online_check('1', '1.00') is True and taxcom.requests == requests_before + 1,
+           taxcom.requests - requests_before)
+    taxcom.found = 'not here'
+    expect('missing check', szpark.online_check('2', '1.00') is False)
+    szpark.online_check('2', '1.00')
+    expect('negative answer not cached', taxcom.requests == requests_before + 3, taxcom.requests - requests_before)
+    taxcom.found = ini.get('onlinefound')
+    taxcom.delay = args.timeout * 3
+    t_start = time.perf_counter()
+    answer = szpark.online_check('3', '1.00')
+    elapsed = time.perf_counter() - t_start
+    expect('deadline', answer is None and elapsed < args.timeout + 0.1, '{} after {:.3f} s'.format(answer, elapsed))
+    cache = szpark.OnlineCache(2, 0.3)
+    cache.put('a', True)
+    cache.put('b', True)
+    cache.get('a')
+    cache.put('c', True)
+    expect('cache LRU eviction', cache.get('b') is None and cache.get('a') and cache.get('c'))
+    time.sleep(0.35)
+    expect('cache TTL', cache.get('a') is None)
+    taxcom.delay = 0.01
+    szpark.online_check('4', '1.00')
+    time.sleep(cfg['online_cache_ttl'] + 0.1)
+    requests_before = taxcom.requests
+    szpark.online_check('4', '1.00')
+    expect('expired answer asked again', taxcom.requests == requests_before + 1)
+    # policy on timeout and background recheck of the stored row
+    result = scan(1, True, args.timeout * 3, True)
+    expect('fail-open opens barrier on timeout', result == (True, True), result)
+    expect('recheck keeps found check ok', stored(1, szpark.R_OK))
+    result = scan(2, False, args.timeout * 3, True)
+    expect('fail-closed keeps barrier closed on timeout', result == (False, False), result)
+    expect('recheck clears online fail', stored(2, szpark.R_OK))
+    result = scan(3, True, args.timeout * 3, False)
+    expect('recheck sets online fail', stored(3, szpark.R_FAIL_ONLINE))
+    result = scan(4, False, 0.01, False)
+    expect('missing check keeps barrier closed', result == (False, False), result)
+    expect('missing check stored as online fail', stored(4, szpark.R_FAIL_ONLINE))
+    shutil.rmtree(tmp, ignore_errors=True)
+    print('{} online check(s) failed'.format(len(failed)) if failed else 'all online checks passed')
+    sys.stdout.flush()
+    # the service worker threads started by online_init do not stop on their own
+    os._exit(1 if failed else 0)
+
+def main():
+    """Parse command line and run benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ini', default=__file__.replace('_bench.py', '.ini'), help='service config')
+    sub = parser.add_subparsers(dest='bench')
+    web = sub.add_parser('web', help='load test of running web interface')
+    web.add_argument('--url', help='web interface url (default from config)')
+    web.add_argument('--requests', type=int, default=200, help='requests per page')
+    web.add_argument('--concurrency', type=int, default=8, help='parallel clients')
+    web.add_argument('--paths', nargs='+', default=['/', '/base', '/log'], help='pages to request')
+    web.set_defaults(fn=bench_web)
+    db = sub.add_parser('db', help='base insert throughput and reader latency')
+    db.add_argument('--rows', type=int, default=5000, help='rows to insert')
+    db.add_argument('--commit-interval', type=float, default=0.2, help='group commit interval (sec)')
+    db.add_argument('--read-interval', type=float, default=0.01, help='pause between reader queries (sec)')
+    db.set_defaults(fn=bench_db)
+    validate = sub.add_parser('validate', help='check validator micro-benchmark')
+    validate.add_argument('--corpus', help='file with recorded QR codes, one per line (default: generated)')
+    validate.add_argument('--rounds', type=int, default=2000, help='passes over the corpus')
+    validate.set_defaults(fn=bench_validate)
+    export = sub.add_parser('export', help='history bulk import, export and re-import throughput by format')
+    export.add_argument('--rows', type=int, default=200000, help='generated checks')
+    export.add_argument('--days', type=int, default=90, help='days of history the checks are spread over')
+    export.set_defaults(fn=bench_export)
+    online = sub.add_parser('online', help='online check policy, deadline, cache and recheck against the stub taxcom')
+    online.add_argument('--timeout', type=float, default=0.2, help='online_timeout, the stub answers slower on timeouts (sec)')
+    online.set_defaults(fn=check_online)
+    replay = sub.add_parser('replay', help='end to end run with virtual scanner, modbus controller and taxcom')
+    replay.add_argument('--payloads', help='file with recorded QR codes, one per line (default: generated valid checks)')
+    replay.add_argument('--retime', action='store_true', help='set recorded check time to now so checks pass the interval')
+    replay.add_argument('--rate', type=float, default=20, help='scans per second per lane')
+    replay.add_argument('--duration', type=float, default=30, help='scanning time (sec)')
+    replay.add_argument('--lanes', type=int, default=1, help='virtual scanners, each with its own barrier coil')
+    replay.add_argument('--online', action='store_true', help='check online against the stub taxcom server')
+    replay.add_argument('--online-delay', type=float, default=0.05, help='stub taxcom answer delay (sec)')
+    replay.add_argument('--web-rate', type=float, default=2, help='web page requests per second during the run')
+    replay.add_argument('--paths', nargs='+', default=['/', '/base', '/log'], help='pages to request')
+    replay.add_argument('--server', choices=('flask', 'waitress'), help='web server (default from config)')
+    replay.add_argument('--drain', type=float, default=10, help='max wait for queued scans after sending (sec)')
+    replay.add_argument('--json', help='save results to file as regression baseline')
+    replay.set_defaults(fn=bench_replay)
+    args = parser.parse_args()
+    if not hasattr(args, 'fn'):
+        parser.print_help()
+        return
+    args.fn(args)
+
+if __name__ == '__main__':
+    main()